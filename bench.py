@@ -0,0 +1,269 @@
+import os
+import sys
+import json
+import lzma
+import math
+import time
+import random
+import hashlib
+import argparse
+import tempfile
+import http.server
+import multiprocessing
+import launcher
+
+# Benchmark for the headless core: serves a synthetic piston-meta index and
+# game manifest from a local HTTP server, then runs install, verify, deep
+# verify and uninstall against it, each in its own process so peak RSS and
+# syscall counts belong to that phase alone. Prints a JSON report.
+
+def parse_size(text):
+    """
+    :param text: A size like "512", "64K", "8M" or "1G".
+    :return: The size in bytes.
+    """
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    if text[-1:].upper() in units:
+        return int(float(text[:-1]) * units[text[-1].upper()])
+    return int(text)
+
+def generate_dataset(data_dir, files, median_size, sigma, max_size, lzma_share, entropy, seed):
+    """
+    Write synthetic game files to data_dir, named by their SHA1 the way the
+    Mojang CDN serves them, and build a manifest pointing at them.
+    :param data_dir: Directory the mock server serves.
+    :param files: How many files to generate.
+    :param median_size: Median file size in bytes; sizes are log-normally distributed.
+    :param sigma: Spread of the size distribution, 0 makes every file median_size.
+    :param max_size: Largest allowed file size in bytes.
+    :param lzma_share: Fraction of files that also get an "lzma" download.
+    :param entropy: Fraction of each file that is random (incompressible) data.
+    :param seed: Seed for the random generator, so runs are reproducible.
+    :return: Tuple of (manifest "files" dict with "{base}" in place of the server URL, dataset stats).
+    """
+    rng = random.Random(seed)
+    entries = {"Dungeons": {"type": "directory"}, "Dungeons/Content": {"type": "directory"}}
+    stats = {"files": files, "raw_bytes": 0, "lzma_files": 0, "lzma_bytes": 0}
+
+    def store(data):
+        sha1 = hashlib.sha1(data).hexdigest()
+        with open(os.path.join(data_dir, sha1), "wb") as f:
+            f.write(data)
+        return {"url": "{base}/" + sha1, "sha1": sha1, "size": len(data)}
+
+    for i in range(files):
+        directory = f"Dungeons/Content/Paks{i % 8}"
+        entries[directory] = {"type": "directory"}
+        size = min(max_size, int(rng.lognormvariate(math.log(max(1, median_size)), sigma)))
+        random_part = int(size * entropy)
+        data = rng.randbytes(random_part) + bytes(size - random_part)
+        downloads = {"raw": store(data)}
+        stats["raw_bytes"] += size
+        if rng.random() < lzma_share:
+            downloads["lzma"] = store(lzma.compress(data, format=lzma.FORMAT_ALONE))
+            stats["lzma_files"] += 1
+            stats["lzma_bytes"] += downloads["lzma"]["size"]
+        entries[f"{directory}/file{i}.pak"] = {"type": "file", "downloads": downloads}
+    return entries, stats
+
+class MockHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves files from data_dir with keep-alive, Range and ETag support,
+    an injected per-request latency and a per-connection bandwidth cap.
+    """
+    protocol_version = "HTTP/1.1"
+    data_dir = "."
+    latency = 0
+    bandwidth = 0
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(self.latency)
+        path = os.path.join(self.data_dir, os.path.basename(self.path))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        etag = f'"{os.path.basename(path)}-{size}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        start = 0
+        range_header = self.headers.get("Range", "")
+        if range_header.startswith("bytes=") and range_header.endswith("-"):
+            start = min(int(range_header[6:-1]), size)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{size - 1}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(size - start))
+        self.send_header("ETag", etag)
+        self.end_headers()
+
+        with open(path, "rb") as f:
+            f.seek(start)
+            began = time.monotonic()
+            sent = 0
+            while chunk := f.read(65536):
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                if self.bandwidth:
+                    ahead = sent / self.bandwidth - (time.monotonic() - began)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(data_dir, latency, bandwidth, ports):
+    """
+    Run the mock piston-meta server until the process is killed.
+    :param ports: Queue the chosen port is reported back on.
+    """
+    MockHandler.data_dir = data_dir
+    MockHandler.latency = latency
+    MockHandler.bandwidth = bandwidth
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), MockHandler)
+    server.daemon_threads = True
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+def read_proc_io():
+    """
+    :return: Dict of read/write syscall counts from /proc/self/io, or None where that doesn't exist.
+    """
+    try:
+        with open("/proc/self/io", "r") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+        return {"read_syscalls": int(counters["syscr"]), "write_syscalls": int(counters["syscw"])}
+    except (OSError, KeyError, ValueError):
+        return None
+
+def peak_rss():
+    """
+    :return: Peak resident set size of this process in bytes, or None if unknown.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+def run_phase(phase, settings, index_url, results):
+    """
+    Run one phase against the mock server and report its measurements.
+    :param phase: "install", "verify", "verify_deep" or "uninstall".
+    :param results: Queue the measurements are put on.
+    """
+    sys.stdout = open(os.devnull, "w") # the core logs every file, keep that out of the report
+    core = launcher.Launcher(settings, index_url=index_url)
+    game_dir = settings["game_dir"]
+    io_before = read_proc_io()
+    began = time.perf_counter()
+
+    result = {"phase": phase}
+    if phase == "install":
+        game_manifest, game_version = core.fetch_latest()
+        result["failed"] = len(core.install(game_manifest, game_dir, game_version))
+    elif phase in ("verify", "verify_deep"):
+        game_manifest, _ = core.fetch_latest(game_dir)
+        report = core.verify(game_manifest, game_dir, deep=phase == "verify_deep")
+        result.update({status: len(paths) for status, paths in report.items()})
+    elif phase == "uninstall":
+        core.uninstall(game_dir)
+
+    wall = time.perf_counter() - began
+    snapshot = core.progress.snapshot()
+    moved = max(snapshot["done"]["downloaded"], snapshot["done"]["hashed"])
+    result.update({
+        "wall_seconds": round(wall, 4),
+        "files": snapshot["done"]["files"],
+        "bytes_downloaded": snapshot["done"]["downloaded"],
+        "bytes_decompressed": snapshot["done"]["decompressed"],
+        "bytes_hashed": snapshot["done"]["hashed"],
+        "throughput_bytes_per_second": round(moved / wall) if wall > 0 else None,
+        "peak_rss_bytes": peak_rss(),
+    })
+    result["metrics"] = core.metrics.summary()
+    io_after = read_proc_io()
+    if io_before is not None and io_after is not None:
+        result.update({key: io_after[key] - io_before[key] for key in io_after})
+    results.put(result)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark install/verify/uninstall against a local mock piston-meta server")
+    parser.add_argument("--files", type=int, default=200, help="number of files in the synthetic manifest")
+    parser.add_argument("--median-size", default="64K", help="median file size")
+    parser.add_argument("--sigma", type=float, default=1.5, help="spread of the log-normal size distribution (0 = fixed size)")
+    parser.add_argument("--max-size", default="256M", help="largest file size")
+    parser.add_argument("--lzma", type=float, default=1.0, help="fraction of files that have an lzma download")
+    parser.add_argument("--entropy", type=float, default=0.5, help="fraction of each file that is incompressible")
+    parser.add_argument("--latency-ms", type=float, default=0, help="latency injected into every request")
+    parser.add_argument("--bandwidth", default="0", help="per-connection bandwidth cap in bytes/s, e.g. 10M (0 = unlimited)")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the synthetic data")
+    parser.add_argument("--phases", default="install,verify,verify_deep,uninstall", help="comma separated phases to run")
+    parser.add_argument("--setting", action="append", default=[], metavar="KEY=VALUE", help="override a launcher setting, VALUE is JSON")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix="piston-bench-") as work_dir:
+        data_dir = os.path.join(work_dir, "srv")
+        os.mkdir(data_dir)
+        entries, stats = generate_dataset(data_dir, args.files, parse_size(args.median_size), args.sigma,
+                                          parse_size(args.max_size), args.lzma, args.entropy, args.seed)
+
+        ports = multiprocessing.Queue()
+        server = multiprocessing.Process(target=serve, args=(data_dir, args.latency_ms / 1000, parse_size(args.bandwidth), ports), daemon=True)
+        server.start()
+        base = f"http://127.0.0.1:{ports.get(timeout=30)}"
+
+        manifest = json.dumps({"files": entries}).replace("{base}", base).encode()
+        manifest_sha1 = hashlib.sha1(manifest).hexdigest()
+        with open(os.path.join(data_dir, manifest_sha1), "wb") as f:
+            f.write(manifest)
+        index = {"dungeons": [{"manifest": {"url": f"{base}/{manifest_sha1}", "sha1": manifest_sha1, "size": len(manifest)}, "version": {"name": "bench"}}]}
+        with open(os.path.join(data_dir, "windows-x64.json"), "w") as f:
+            f.write(json.dumps(index))
+
+        settings = launcher.load_settings(os.path.join(work_dir, "settings.json"))
+        settings["game_dir"] = os.path.join(work_dir, "game")
+        settings["cache_dir"] = os.path.join(work_dir, "cache")
+        settings["metrics_file"] = ""
+        for override in args.setting:
+            key, _, value = override.partition("=")
+            settings[key] = json.loads(value)
+
+        results = multiprocessing.Queue()
+        phases = []
+        try:
+            for phase in args.phases.split(","):
+                worker = multiprocessing.Process(target=run_phase, args=(phase, settings, f"{base}/windows-x64.json", results))
+                worker.start()
+                worker.join()
+                if worker.exitcode != 0:
+                    phases.append({"phase": phase, "error": f"exited with code {worker.exitcode}"})
+                    break
+                phases.append(results.get())
+        finally:
+            server.terminate()
+
+    report = {
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "settings": {key: value for key, value in settings.items() if key not in ("game_dir", "cache_dir")},
+        "dataset": stats,
+        "phases": phases,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
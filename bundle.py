@@ -0,0 +1,62 @@
+import os
+import json
+import struct
+
+# Offline install bundles: a whole game directory in one file, for machines
+# that can't reach Mojang. The layout is
+#
+#   MAGIC | payload | payload | ... | manifest JSON | index JSON | trailer
+#
+# where every payload is one game file, either stored as is or LZMA
+# compressed, and the trailer at the very end says where the index is. The
+# index maps manifest paths to [offset, length, "stored" or "lzma"], so the
+# bundle can be written in one sequential pass and read with random access.
+
+MAGIC = b"PISTONB1"
+TRAILER = struct.Struct("<QQ8s") # index offset, index length, MAGIC
+FORMAT = 1
+
+class BundleError(Exception):
+    """
+    Raised when a file isn't a bundle, is damaged, or can't be made.
+    """
+
+def write_index(f, index):
+    """
+    Append the index and the trailer pointing at it.
+    :param f: The bundle, opened for writing and positioned at its end.
+    :param index: The index dict.
+    """
+    data = json.dumps(index).encode()
+    offset = f.tell()
+    f.write(data)
+    f.write(TRAILER.pack(offset, len(data), MAGIC))
+
+def read_index(mapped):
+    """
+    Find and parse the index of a bundle.
+    :param mapped: The whole bundle, e.g. an mmap of it.
+    :return: The index dict.
+    :raises BundleError: If this isn't a bundle we can read.
+    """
+    if len(mapped) < len(MAGIC) + TRAILER.size or mapped[:len(MAGIC)] != MAGIC:
+        raise BundleError("not a game bundle")
+    offset, length, magic = TRAILER.unpack_from(mapped, len(mapped) - TRAILER.size)
+    if magic != MAGIC or offset + length > len(mapped) - TRAILER.size:
+        raise BundleError("bundle is truncated or damaged")
+    try:
+        index = json.loads(bytes(mapped[offset:offset + length]))
+    except ValueError:
+        raise BundleError("bundle index is damaged")
+    if index.get("format") != FORMAT:
+        raise BundleError(f"bundle format {index.get('format')} isn't supported")
+    return index
+
+def check_path(path):
+    """
+    Make sure a path from a bundle's manifest stays inside the game directory.
+    :param path: The manifest path.
+    :raises BundleError: If the path is absolute or climbs out with "..".
+    """
+    if os.path.isabs(path) or os.path.splitdrive(path)[0] or path.startswith(("/", "\\")) or ".." in path.replace("\\", "/").split("/"):
+        raise BundleError(f"bundle has an unsafe path: {path}")
@@ -0,0 +1,114 @@
+import os
+import sys
+import argparse
+import bundle
+import launcher
+
+def print_progress(snapshot):
+    print(f"PROGRESS {snapshot['phase']} {launcher.format_progress(snapshot)}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="piston-launcher", description="Headless launcher for Minecraft: Dungeons")
+    parser.add_argument("--settings", default="settings.json", help="path to settings.json")
+    parser.add_argument("--game-dir", help="override the game directory from the settings")
+    parser.add_argument("--offline", action="store_true", help="don't touch the network, use the cached manifests")
+    parser.add_argument("--peer", action="append", default=[], metavar="URL", help="launcher on the LAN to fetch files from before going upstream (repeatable)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("install", help="install or update the game")
+    verify_parser = commands.add_parser("verify", help="verify and repair the game files")
+    verify_parser.add_argument("--deep", action="store_true", help="rehash every file even if it looks unchanged")
+    commands.add_parser("uninstall", help="delete the game directory")
+    status_parser = commands.add_parser("status", help="show the installed game version")
+    status_parser.add_argument("--check", action="store_true", help="also check whether there's an update")
+    export_parser = commands.add_parser("export", help="pack the installed game into a bundle file for offline installs")
+    export_parser.add_argument("bundle", help="path of the bundle to write")
+    export_parser.add_argument("--compress", action="store_true", help="lzma-compress the files (smaller, slower to make)")
+    import_parser = commands.add_parser("import", help="install the game from a bundle file")
+    import_parser.add_argument("bundle", help="path of the bundle to read")
+    serve_parser = commands.add_parser("serve", help="share the installed game files with other launchers on the LAN")
+    serve_parser.add_argument("--host", default="", help="address to listen on (default: all)")
+    serve_parser.add_argument("--port", type=int, help="port to listen on (default: peer_port from the settings)")
+    args = parser.parse_args(argv)
+
+    settings = launcher.load_settings(args.settings)
+    if args.game_dir:
+        settings["game_dir"] = args.game_dir
+    if args.offline:
+        settings["offline"] = True
+    if args.peer:
+        settings["peers"] = args.peer
+    game_dir = settings["game_dir"]
+
+    core = launcher.Launcher(settings, on_progress=print_progress, refresh_rate=1)
+    core.recover_staging(game_dir)
+
+    if args.command == "status":
+        version = core.installed_version(game_dir)
+        print(f"Game directory: {os.path.abspath(game_dir)}")
+        print(f"Game version: {version if version else 'Not installed'}")
+        if args.check and version:
+            update = core.check_update(game_dir)
+            if update is None:
+                print("No update available")
+            else:
+                print(f"Update available: {update['version']}, {update['files']} files, {update['download'] // (1024 * 1024)} MB to download")
+        return 0
+
+    if args.command == "export":
+        try:
+            core.export_bundle(game_dir, args.bundle, args.compress)
+        except bundle.BundleError as e:
+            print(f"Can't export: {e}")
+            return 1
+        return 0
+
+    if args.command == "import":
+        try:
+            failed = core.import_bundle(args.bundle, game_dir)
+        except bundle.BundleError as e:
+            print(f"Can't import: {e}")
+            return 1
+        return 1 if failed else 0
+
+    if args.command == "serve":
+        import peer
+        if core.installed_version(game_dir) is None:
+            print("Game is not installed")
+            return 1
+        server = peer.PeerServer(settings, game_dir, args.host, args.port or int(settings["peer_port"]))
+        print(f"Sharing {os.path.abspath(game_dir)} on port {server.server_address[1]}, Ctrl+C to stop")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    if args.command == "uninstall":
+        if core.installed_version(game_dir) is None and not os.path.exists(game_dir):
+            print("Game is not installed")
+            return 1
+        core.uninstall(game_dir)
+        return 0
+
+    try:
+        game_manifest, game_version = core.fetch_latest(game_dir)
+    except launcher.OfflineError as e:
+        print(f"Can't fetch the game manifest: {e}")
+        return 1
+    except KeyError as e:
+        print(f"The game index has changed in a way this launcher doesn't understand (missing {e}), check for a launcher update")
+        return 1
+
+    if args.command == "install":
+        failed = core.install(game_manifest, game_dir, game_version)
+        return 1 if failed else 0
+
+    if args.command == "verify":
+        if core.installed_version(game_dir) is None:
+            print("Game is not installed")
+            return 1
+        report = core.verify(game_manifest, game_dir, args.deep)
+        return 1 if report["failed"] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
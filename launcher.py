@@ -0,0 +1,2038 @@
+import os
+import json
+import mmap
+import threading
+import time
+import shutil
+import tempfile
+import importlib
+import concurrent.futures # the executors themselves are only imported on first use
+import bundle
+import metrics
+from manifest import Manifest, ManifestIndex
+from collections import deque
+
+class LazyModule:
+    """
+    Stands in for a module and imports it the first time one of its
+    attributes is used, so opening the launcher just to press Play doesn't
+    pay for requests (most of the startup time), lzma and the like.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.module = None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            with self.lock:
+                if self.module is None:
+                    self.module = importlib.import_module(self.name)
+        return getattr(self.module, attr)
+
+hashlib = LazyModule("hashlib")
+requests = LazyModule("requests")
+l = LazyModule("lzma") # TODO: the game manifest has {"lzma":{"url":"whatever"}} for compressed files, have to either fix that or do this
+
+# TODO: make not hardcoded. will be hard since the random string at
+# the beginning of each file is the hash of that file, and i haven't
+# found a manifest 1 level higher than this
+INDEX_URL = "https://piston-meta.mojang.com/v1/products/dungeons/f4c685912beb55eb2d5c9e0713fe1195164bba27/windows-x64.json"
+
+DEFAULT_SETTINGS = {
+    "game_dir": "dungeons",
+    "lzma_mem_cap": 128,
+    "download_raw": False,
+    "download_threads": 8,
+    "stream_lzma": True,
+    "object_store": "",
+    "object_store_cap": 20,
+    "cache_dir": "cache",
+    "offline": False,
+    "decompress_workers": 0,
+    "metrics_file": "metrics.jsonl",
+    "prometheus_file": "",
+    "download_limit": 0,
+    "peers": [],
+    "share_files": False,
+    "peer_port": 8625,
+}
+
+class OfflineError(Exception):
+    """
+    Raised when a document is needed from piston-meta, it can't be reached
+    (or offline mode is on) and there is no cached copy of it.
+    """
+
+def load_settings(path="settings.json"):
+    """
+    Load the launcher settings, filling in defaults for anything missing.
+    :param path: Path to settings.json.
+    :return: The settings dict.
+    """
+    settings = {}
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            settings = json.loads(f.read())
+    for key, value in DEFAULT_SETTINGS.items():
+        settings[key] = settings.get(key, value)
+    if int(settings["lzma_mem_cap"]) <= 0: # 0 used to mean uncapped, which isn't a thing anymore
+        settings["lzma_mem_cap"] = DEFAULT_SETTINGS["lzma_mem_cap"]
+    return settings
+
+def save_settings(settings, path="settings.json"):
+    """
+    Write the launcher settings back to disk.
+    :param settings: The settings dict.
+    :param path: Path to settings.json.
+    """
+    with open(path, 'w') as f:
+        f.write(json.dumps(settings))
+
+def replace_file(path, data):
+    """
+    Atomically write a file through a temporary file with a unique name, so
+    two launchers writing the same cache file at once can't trip over each
+    other's temporary file.
+    :param path: Path of the file to write.
+    :param data: The new contents, bytes.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+class Progress:
+    """
+    Thread-safe byte and file counters for one install, verify or uninstall.
+    Workers call add() as often as they like; on_update(snapshot) is called
+    at most refresh_rate times per second, from whichever worker happens to
+    cross the interval, plus once more when the run finishes.
+    """
+    primary = {"install": "downloaded", "verify": "hashed", "uninstall": "files", "import": "hashed"}
+
+    def __init__(self, on_update=None, refresh_rate=4):
+        self.on_update = on_update
+        self.on_add = None
+        self.interval = 1 / refresh_rate
+        self.lock = threading.Lock()
+        self.start("idle")
+
+    def start(self, phase, files=0, download=0, decompress=0, hash=0):
+        """
+        Reset the counters for a new run.
+        :param phase: "install", "verify" or "uninstall".
+        :param files: How many manifest entries will be processed.
+        :param download: How many bytes will be downloaded.
+        :param decompress: How many bytes will be decompressed.
+        :param hash: How many bytes will be hashed.
+        """
+        with self.lock:
+            self.phase = phase
+            self.done = {"files": 0, "downloaded": 0, "decompressed": 0, "hashed": 0}
+            self.total = {"files": files, "downloaded": download, "decompressed": decompress, "hashed": hash}
+            self.started = time.monotonic()
+            self.samples = [(self.started, 0)]
+            self.last_update = 0
+
+    def add(self, files=0, downloaded=0, decompressed=0, hashed=0):
+        """
+        Count finished work.
+        """
+        if self.on_add is not None:
+            self.on_add(downloaded=downloaded, decompressed=decompressed, hashed=hashed)
+        with self.lock:
+            self.done["files"] += files
+            self.done["downloaded"] += downloaded
+            self.done["decompressed"] += decompressed
+            self.done["hashed"] += hashed
+            now = time.monotonic()
+            if now - self.last_update < self.interval:
+                return
+            self.last_update = now
+            snapshot = self.take_snapshot(now)
+        if self.on_update is not None:
+            self.on_update(snapshot)
+
+    def skip(self, download=0, decompress=0, hash=0):
+        """
+        Take work off the totals that turned out not to be needed,
+        e.g. a file that came from the object store or hadn't changed.
+        """
+        with self.lock:
+            self.total["downloaded"] -= download
+            self.total["decompressed"] -= decompress
+            self.total["hashed"] -= hash
+
+    def finish(self):
+        """
+        Send out the final numbers of the run.
+        """
+        with self.lock:
+            snapshot = self.take_snapshot(time.monotonic())
+        if self.on_update is not None:
+            self.on_update(snapshot)
+
+    def snapshot(self):
+        with self.lock:
+            return self.take_snapshot(time.monotonic())
+
+    def take_snapshot(self, now):
+        """
+        :return: Dict with the phase, "done" and "total" counters, the overall
+                 "fraction" done, the "rate" (primary units per second, over
+                 the last 5 seconds) and "eta" in seconds (None if unknown).
+        """
+        key = self.primary.get(self.phase, "files")
+        self.samples.append((now, self.done[key]))
+        while len(self.samples) > 2 and now - self.samples[0][0] > 5:
+            self.samples.pop(0)
+        elapsed = now - self.samples[0][0]
+        rate = (self.done[key] - self.samples[0][1]) / elapsed if elapsed > 0 else 0
+        total = self.total[key]
+        if total <= 0:
+            key, total = "files", self.total["files"]
+        fraction = min(1, self.done[key] / total) if total > 0 else 0
+        eta = (total - self.done[key]) / rate if rate > 0 and key == self.primary.get(self.phase) else None
+        return {
+            "phase": self.phase,
+            "unit": key,
+            "done": dict(self.done),
+            "total": dict(self.total),
+            "fraction": fraction,
+            "rate": rate,
+            "eta": eta,
+            "elapsed": now - self.started,
+        }
+
+def format_progress(snapshot):
+    """
+    Turn a progress snapshot into a short human readable line.
+    :param snapshot: A snapshot from Progress.
+    :return: e.g. "12/300 files, 120/2300 MB, 12.3 MB/s, ETA 1:23"
+    """
+    done, total = snapshot["done"], snapshot["total"]
+    text = f"{done['files']}/{total['files']}"
+    if snapshot["unit"] != "files":
+        mb = 1024 * 1024
+        text += f", {done[snapshot['unit']] // mb}/{total[snapshot['unit']] // mb} MB, {snapshot['rate'] / mb:.1f} MB/s"
+    if snapshot["eta"] is not None:
+        minutes, seconds = divmod(int(snapshot["eta"]), 60)
+        text += f", ETA {minutes}:{seconds:02}"
+    return text
+
+class MemoryBudget:
+    """
+    A pool of bytes shared by every decompressor the launcher runs, so the
+    total they hold at once never goes over the limit no matter how many
+    run in parallel. A single reservation bigger than the whole budget is
+    shrunk to the budget, so it still runs, just on its own.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def reserve(self, amount):
+        """
+        Block until amount bytes are free and take them.
+        :return: How many bytes were actually reserved; pass this to release().
+        """
+        amount = min(amount, self.limit)
+        with self.condition:
+            self.condition.wait_for(lambda: self.used + amount <= self.limit)
+            self.used += amount
+        return amount
+
+    def release(self, amount):
+        with self.condition:
+            self.used -= amount
+            self.condition.notify_all()
+
+class RateLimiter:
+    """
+    A token bucket shared by every download thread, keeping the launcher as
+    a whole under a bytes/sec limit. Threads that take more than is left go
+    into debt and sleep it off, outside the lock, so the others keep going.
+    """
+    def __init__(self, rate):
+        """
+        :param rate: Bytes per second, 0 for no limit.
+        """
+        self.rate = rate
+        self.allowance = rate # up to a second's worth can go out in a burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        """
+        Take amount bytes from the bucket, sleeping if that goes over the limit.
+        """
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate)
+            self.last = now
+            self.allowance -= amount
+            wait = -self.allowance / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+class DownloadScheduler:
+    """
+    Hands download jobs out to the worker threads. The largest files go
+    first so they're not left running alone at the end, and small files are
+    handed out in batches so a worker gets through many of them per trip.
+    How many workers may download at once starts at all of them and is
+    tuned by hill climbing on the measured throughput: keep stepping while
+    it improves, turn around when it drops, stay put when it's flat.
+    """
+    small_file = 256 * 1024 # files smaller than this get batched
+    batch_bytes = 4 * 1024 * 1024
+    batch_files = 32
+    interval = 2 # seconds of throughput measured per adjustment
+
+    def __init__(self, max_workers):
+        self.max_workers = max(1, max_workers)
+        self.limit = self.max_workers
+        self.step = -1
+        self.active = 0
+        self.pending = deque()
+        self.condition = threading.Condition()
+        self.window_start = time.monotonic()
+        self.window_bytes = 0
+        self.last_rate = None
+
+    def plan(self, jobs, size):
+        """
+        Queue up the jobs, largest first, with the small ones batched.
+        :param jobs: List of job tuples.
+        :param size: Function giving the download size of a job.
+        """
+        # small enough batches that every worker still gets a few of them
+        small = sum(1 for job in jobs if size(job) < self.small_file)
+        batch_files = max(1, min(self.batch_files, small // (self.max_workers * 4)))
+        batch = []
+        batch_size = 0
+        for job in sorted(jobs, key=size, reverse=True):
+            job_size = size(job)
+            if job_size >= self.small_file:
+                self.pending.append([job])
+                continue
+            batch.append(job)
+            batch_size += job_size
+            if batch_size >= self.batch_bytes or len(batch) >= batch_files:
+                self.pending.append(batch)
+                batch = []
+                batch_size = 0
+        if batch:
+            self.pending.append(batch)
+
+    def next_batch(self):
+        """
+        Block until this worker may download, then take the next batch.
+        :return: List of jobs, or None when there's nothing left.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: not self.pending or self.active < self.limit)
+            if not self.pending:
+                return None
+            self.active += 1
+            return self.pending.popleft()
+
+    def done(self):
+        """
+        Give back the slot taken by next_batch().
+        """
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def count(self, amount):
+        """
+        Count downloaded bytes, adjusting the worker limit once per interval.
+        """
+        with self.condition:
+            self.window_bytes += amount
+            now = time.monotonic()
+            elapsed = now - self.window_start
+            if elapsed < self.interval:
+                return
+            rate = self.window_bytes / elapsed
+            self.window_start = now
+            self.window_bytes = 0
+            if self.last_rate is not None:
+                if rate < self.last_rate * 0.95:
+                    self.step = -self.step
+                elif rate <= self.last_rate * 1.05:
+                    self.last_rate = rate
+                    return
+            self.last_rate = rate
+            limit = min(self.max_workers, max(1, self.limit + self.step))
+            if limit != self.limit:
+                self.limit = limit
+                print(f"SCHEDULER {limit} connections at {rate / (1024 * 1024):.1f} MB/s")
+                self.condition.notify_all()
+
+class InstallJournal:
+    """
+    Write-ahead journal of a staged install: one JSON line per file that
+    has been fully downloaded, verified and moved into place, with the
+    size and mtime it was left with. An interrupted install trusts the
+    files it lists whose stat data still matches, without hashing them.
+    Lines are flushed as they're written and fsynced at most once a
+    second; losing the last few to a power cut only means redoing those files.
+    """
+    sync_interval = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue # torn by a crash mid-write
+                    self.done[record["path"]] = record
+        self.file = open(path, 'a')
+        if self.file.tell() and not self.ends_with_newline():
+            self.file.write("\n")
+        self.synced = time.monotonic()
+
+    def ends_with_newline(self):
+        with open(self.path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def is_done(self, path, sha1, file_path):
+        """
+        :param path: Manifest path of the file.
+        :param sha1: SHA1 digest (bytes) the file should have.
+        :param file_path: Where the file is on disk.
+        :return: True if the journal says the file is done and it hasn't changed since.
+        """
+        record = self.done.get(path)
+        if record is None or record["sha1"] != sha1.hex():
+            return False
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return False
+        return (record["size"], record["mtime"]) == (st.st_size, st.st_mtime_ns)
+
+    def add(self, path, sha1, file_path):
+        """
+        Record a finished file.
+        """
+        st = os.stat(file_path)
+        line = json.dumps({"path": path, "sha1": sha1.hex(), "size": st.st_size, "mtime": st.st_mtime_ns}) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+            now = time.monotonic()
+            if now - self.synced >= self.sync_interval:
+                os.fsync(self.file.fileno())
+                self.synced = now
+
+    def close(self):
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+
+def lzma_dict_size(header):
+    """
+    Work out how much memory decoding an LZMA stream needs from its first bytes.
+    :param header: At least the first 5 bytes of the stream.
+    :return: The dictionary size in bytes.
+    """
+    if header[:6] == b"\xfd7zXZ\x00":
+        return 8 * 1024 * 1024 # xz doesn't say up front, this is what preset 6 uses
+    if len(header) < 5:
+        return 8 * 1024 * 1024
+    return int.from_bytes(header[1:5], "little")
+
+def decompress_worker(src_path, dst_path, max_length):
+    """
+    Decompress src_path into dst_path, holding at most max_length bytes of
+    output at a time. Runs in a worker process of the decompression stage.
+    :return: How many bytes were written.
+    """
+    decompressor = l.LZMADecompressor()
+    written = 0
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        while not decompressor.eof:
+            if decompressor.needs_input:
+                chunk = src.read(1024 * 1024)
+                if not chunk:
+                    break
+            else:
+                chunk = b""
+            data = decompressor.decompress(chunk, max_length)
+            dst.write(data)
+            written += len(data)
+    return written
+
+def compress_worker(src_path, dst_path):
+    """
+    LZMA-compress src_path into dst_path. Runs in a worker process when
+    exporting a compressed bundle.
+    :return: The compressed size.
+    """
+    compressor = l.LZMACompressor(format=l.FORMAT_ALONE)
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        while chunk := src.read(1024 * 1024):
+            dst.write(compressor.compress(chunk))
+        dst.write(compressor.flush())
+        return dst.tell()
+
+class Launcher:
+    """
+    Everything the launcher does to the game files, without any GUI.
+    Progress is tracked in self.progress; pass on_progress to get its
+    snapshots pushed at refresh_rate, or poll self.progress.snapshot().
+    """
+    resume_threshold = 32 * 1024 * 1024 # compressed files this big or bigger are downloaded resumably
+
+    def __init__(self, settings, on_progress=None, refresh_rate=4, index_url=INDEX_URL):
+        self.settings = settings
+        self.index_url = index_url
+        self.progress = Progress(on_progress, refresh_rate)
+        self.metrics = metrics.Metrics()
+        self.progress.on_add = self.metrics.count
+        self.session = None
+        self.index_dir = None
+        self.file_index = {}
+        self.index_lock = threading.Lock()
+        self.store_dir = None
+        self.store_lru = {}
+        self.decompress_pool = None
+        self.memory_budget = MemoryBudget(self.lzma_budget())
+        self.scheduler = None
+        self.rate_limiter = RateLimiter(0)
+        self.dead_peers = set()
+        self.journal = None
+
+    def fetch_latest(self, game_dir=None):
+        """
+        Fetch the manifest of the latest game version from piston-meta.
+        In offline mode, or when piston-meta can't be reached, the cached
+        copies are used instead, and failing that the manifest the game in
+        game_dir was installed from.
+        :param game_dir: Directory path to the game files, for the offline fallback.
+        :return: Tuple of (game Manifest, version name).
+        :raises KeyError: If the index isn't laid out the way we expect anymore.
+        :raises OfflineError: If there is nothing to fall back to.
+        """
+        try:
+            index = self.fetch_json(self.index_url)
+            manifest_info = index["dungeons"][0]["manifest"]
+            game_version = index["dungeons"][0]["version"]["name"]
+            key = manifest_info.get("sha1") or hashlib.sha1(manifest_info["url"].encode()).hexdigest()
+            return Manifest(self.fetch_json(manifest_info["url"]), key), game_version
+        except OfflineError:
+            if game_dir is None:
+                raise
+            installed_manifest = self.load_installed_manifest(game_dir)
+            if installed_manifest is None:
+                raise
+            print(f"OFFLINE using the manifest installed in {game_dir}")
+            return installed_manifest, self.installed_version(game_dir)
+
+    def check_update(self, game_dir):
+        """
+        See whether there's a newer game than the installed one. The index and
+        manifest come from the cache, revalidated with a conditional request
+        (so a 304 when nothing changed, and nothing at all in offline mode),
+        and both manifests are compiled from the index cache, so this is
+        cheap enough to do on every startup.
+        :param game_dir: Directory path to the game files.
+        :return: Dict with the new "version", how many "files" updating
+                 changes and how many bytes it will "download", or None if
+                 the game is up to date, isn't installed or we can't tell.
+        """
+        installed_manifest = self.load_installed_manifest(game_dir)
+        if installed_manifest is None:
+            return None
+        try:
+            game_manifest, game_version = self.fetch_latest()
+        except (OfflineError, KeyError) as e:
+            print(f"UPDATE can't check ({e})")
+            return None
+        index = self.compile_manifest(game_manifest)
+        diff = self.diff_manifests(self.compile_manifest(installed_manifest), index)
+        changed = set(diff["added"]) | set(diff["changed"])
+        if not changed and not diff["removed"]:
+            print("UPDATE game is up to date")
+            return None
+        download = sum(self.download_size(entry) for entry in index.files if entry.path in changed)
+        print(f"UPDATE {game_version} available, {len(changed)} files, {download // (1024 * 1024)} MB")
+        return {"version": game_version, "files": len(changed), "download": download}
+
+    def fetch_json(self, url):
+        """
+        Fetch a JSON document, keeping a copy of it in the cache directory.
+        The cached copy is revalidated with its ETag/Last-Modified, so an
+        unchanged document costs a 304 and is never downloaded again.
+        :param url: The URL of the document.
+        :return: The parsed document.
+        :raises OfflineError: If the document can't be fetched and isn't cached.
+        """
+        cache_dir = self.settings.get("cache_dir")
+        name = hashlib.sha1(url.encode()).hexdigest()
+        body_path = os.path.join(cache_dir, name + ".json")
+        meta_path = os.path.join(cache_dir, name + ".meta.json")
+
+        meta = {}
+        if os.path.exists(body_path) and os.path.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                meta = json.loads(f.read())
+
+        def cached():
+            if not meta:
+                raise OfflineError(f"{url} isn't cached")
+            with open(body_path, 'rb') as f:
+                return json.loads(f.read())
+
+        if self.settings.get("offline") is True:
+            print(f"OFFLINE {url}")
+            return cached()
+
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        try:
+            response = self.get_session().get(url, headers=headers, timeout=30)
+            if response.status_code == 304:
+                print(f"GET {url} NOT MODIFIED")
+                return cached()
+            response.raise_for_status()
+        except requests.RequestException as e:
+            print(f"GET {url} FAILED ({e}), trying the cache")
+            return cached()
+
+        document = json.loads(response.content)
+        os.makedirs(cache_dir, exist_ok=True)
+        replace_file(body_path, response.content)
+        replace_file(meta_path, json.dumps({"url": url, "etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}).encode())
+        print(f"GET {url} OK")
+        return document
+
+    def installed_version(self, game_dir):
+        """
+        :param game_dir: Directory path to the game files.
+        :return: The installed game version, or None if the game isn't installed.
+        """
+        version_path = os.path.join(game_dir, ".version")
+        if not os.path.exists(version_path):
+            return None
+        with open(version_path, 'r') as f:
+            return f.read().strip()
+
+    def install(self, game_manifest, game_dir, game_version):
+        """
+        Proceed with installation of Minecraft Dungeons
+        The game is built in a staging directory next to game_dir: files an
+        update doesn't change are hardlinked over from the installed game,
+        everything else is downloaded, and a journal records every finished
+        file so an interrupted install picks up where it left off. Once all
+        files are in, the staging directory is swapped in for game_dir and
+        only then is .version written.
+        :param game_manifest: The game manifest to install from.
+        :param game_dir: Directory path to install the game to.
+        :param game_version: Version name of the manifest.
+        :return: List of (file_path, entry) tuples that could not be installed.
+                 If there are any, game_dir is left as it was and the staging
+                 directory is kept, so installing again resumes.
+        """
+        self.recover_staging(game_dir)
+        staging_dir = self.staging_dir(game_dir)
+        os.makedirs(staging_dir, exist_ok=True)
+
+        index = self.compile_manifest(game_manifest)
+        old_manifest = self.load_installed_manifest(game_dir)
+        old_paths = set()
+        unchanged = set()
+        if old_manifest is None:
+            entries = index.files
+        else:
+            old_index = self.compile_manifest(old_manifest)
+            diff = self.diff_manifests(old_index, index)
+            print(f"DELTA {len(diff['added'])} added, {len(diff['changed'])} changed, {len(diff['removed'])} removed, {len(diff['unchanged'])} unchanged")
+            wanted = set(diff["added"]) | set(diff["changed"])
+            entries = [entry for entry in index.files if entry.path in wanted]
+            old_paths = {entry.path for entry in old_index.files}
+            unchanged = set(diff["unchanged"])
+            full_size = index.download_bytes(self.settings["download_raw"])
+            saved_size = full_size - sum(self.download_size(entry) for entry in entries)
+            print(f"DELTA saved {saved_size // (1024 * 1024)} MB of {full_size // (1024 * 1024)} MB")
+        if os.path.isdir(game_dir):
+            # keep what the update doesn't touch, and anything that isn't ours
+            new_paths = {entry.path for entry in index.files}
+            linked = self.carry_over(game_dir, staging_dir, lambda path: path in unchanged or (path not in old_paths and path not in new_paths))
+        else:
+            linked = set()
+        # an unchanged file that's gone from game_dir, or was changed since it
+        # was last verified, has to be fetched like any other
+        stale = {entry.path for entry in index.files if entry.path in unchanged and (entry.path not in linked or (entry.raw_sha1 and not self.is_unchanged(os.path.join(staging_dir, entry.path), entry.raw_sha1)))}
+        if stale:
+            print(f"DELTA {len(stale)} unchanged files are missing or modified, fetching them")
+            entries = [entry for entry in index.files if entry.path in wanted or entry.path in stale]
+
+        self.journal = InstallJournal(os.path.join(staging_dir, ".journal"))
+        try:
+            staged = {entry.path for entry in entries if entry.raw_sha1 and self.journal.is_done(entry.path, entry.raw_sha1, os.path.join(staging_dir, entry.path))}
+            if staged:
+                print(f"RESUME {len(staged)} files already staged")
+                entries = [entry for entry in entries if entry.path not in staged]
+
+            self.metrics.start_run("install")
+            self.progress.start(
+                "install",
+                files=len(entries),
+                download=sum(self.download_size(entry) for entry in entries),
+                decompress=sum(self.decompress_size(entry) for entry in entries),
+            )
+            failed = self.install_entries(index, entries, staging_dir)
+        finally:
+            self.journal.close()
+            self.journal = None
+
+        if failed:
+            print(f"STAGING {len(failed)} files failed, {game_dir} is unchanged, install again to resume")
+        else:
+            self.save_installed_manifest(game_manifest, staging_dir)
+            self.swap_staging(staging_dir, game_dir, game_version)
+        self.progress.finish()
+        self.write_metrics()
+        return failed
+
+    def staging_dir(self, game_dir):
+        """
+        :param game_dir: Directory path to the game files.
+        :return: Where installs into game_dir are staged; next to it, so
+                 swapping it in is a rename on the same filesystem.
+        """
+        return os.path.normpath(game_dir) + ".staging"
+
+    def carry_over(self, game_dir, staging_dir, keep):
+        """
+        Hardlink (or copy, where that's not possible) files from the installed
+        game into the staging directory, along with their file-state index
+        entries, so they don't have to be hashed again either.
+        :param game_dir: Directory path to the game files.
+        :param staging_dir: The staging directory.
+        :param keep: Function taking a manifest-style path, True if the file should be carried over.
+        :return: Set of the manifest-style paths that were carried over.
+        """
+        self.load_index(game_dir)
+        old_index = self.file_index
+        files, _ = self.scan_tree(game_dir)
+        jobs = []
+        for file_path in files:
+            path = os.path.relpath(file_path, game_dir).replace(os.sep, "/")
+            if path.startswith(".") and "/" not in path:
+                continue # the launcher's own files, the staged install gets new ones
+            if path.endswith((".tmp", ".part", ".part.json")) or not keep(path):
+                continue
+            jobs.append((file_path, os.path.join(staging_dir, path)))
+
+        def carry(src, dst):
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            self.link_file(src, dst)
+
+        failed = self.run_concurrently(carry, jobs, workers=min(32, (os.cpu_count() or 1) * 4))
+        if failed:
+            print(f"STAGING {len(failed)} files couldn't be carried over")
+        jobs = [job for job in jobs if job not in failed]
+        self.load_index(staging_dir)
+        for src, dst in jobs:
+            record = old_index.get(os.path.relpath(src, game_dir))
+            if record is not None:
+                self.file_index[os.path.relpath(dst, staging_dir)] = record
+        self.save_index()
+        print(f"STAGING carried over {len(jobs)} files from {game_dir}")
+        return {os.path.relpath(dst, staging_dir).replace(os.sep, "/") for _, dst in jobs}
+
+    def swap_staging(self, staging_dir, game_dir, game_version):
+        """
+        Swap a finished staging directory in for game_dir. A .staged marker
+        holding the version goes in first, so recover_staging() can finish
+        the job if we're interrupted; the old game directory is renamed out
+        of the way and deleted in the background like an instant uninstall.
+        :param staging_dir: The staging directory.
+        :param game_dir: Directory path to the game files.
+        :param game_version: Version name to write to .version.
+        """
+        with open(os.path.join(staging_dir, ".staged"), 'w') as f:
+            f.write(game_version)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(os.path.join(staging_dir, ".journal")):
+            os.remove(os.path.join(staging_dir, ".journal"))
+        trash_dir = None
+        if os.path.exists(game_dir):
+            trash_dir = f"{os.path.normpath(game_dir)}.trash-{int(time.time() * 1000)}"
+            os.rename(game_dir, trash_dir)
+        os.rename(staging_dir, game_dir)
+        self.write_version(game_dir)
+        print(f"STAGING {staging_dir} -> {game_dir} OK")
+        if trash_dir is not None:
+            threading.Thread(target=self.delete_tree, args=(trash_dir, False)).start()
+
+    def write_version(self, game_dir):
+        """
+        Turn the .staged marker of a swapped in install into .version.
+        :param game_dir: Directory path to the game files.
+        """
+        marker_path = os.path.join(game_dir, ".staged")
+        version_path = os.path.join(game_dir, ".version")
+        with open(marker_path, 'r') as f:
+            game_version = f.read()
+        with open(version_path + ".tmp", 'w') as f:
+            f.write(game_version)
+        os.replace(version_path + ".tmp", version_path)
+        os.remove(marker_path)
+
+    def recover_staging(self, game_dir):
+        """
+        Finish a swap that was interrupted after the staged install was
+        complete. Cheap enough to call on every startup: it's a couple of
+        stats unless there is something to do.
+        :param game_dir: Directory path to the game files.
+        """
+        staging_dir = self.staging_dir(game_dir)
+        if os.path.exists(os.path.join(staging_dir, ".staged")):
+            print(f"STAGING finishing the interrupted swap of {staging_dir}")
+            trash_dir = f"{os.path.normpath(game_dir)}.trash-{int(time.time() * 1000)}"
+            try:
+                if os.path.exists(game_dir):
+                    os.rename(game_dir, trash_dir)
+                os.rename(staging_dir, game_dir)
+            except OSError as e:
+                print(f"STAGING can't swap in {staging_dir} yet ({e})")
+                return
+            if os.path.exists(trash_dir):
+                threading.Thread(target=self.delete_tree, args=(trash_dir, False)).start()
+        if os.path.exists(os.path.join(game_dir, ".staged")):
+            self.write_version(game_dir)
+
+    def verify(self, game_manifest, game_dir, deep=False):
+        """
+        Verify the installed game files, repairing any that are missing or broken.
+        :param game_manifest: The game manifest to verify against.
+        :param game_dir: Directory path to the game files.
+        :param deep: Rehash every file even if the index says it hasn't changed.
+        :return: The verify report, see verify_entries().
+        """
+        index = self.compile_manifest(game_manifest)
+        self.metrics.start_run("verify_deep" if deep else "verify")
+        self.progress.start("verify", files=index.file_count, hash=index.raw_bytes)
+        report = self.verify_entries(index, game_dir, deep)
+        self.progress.finish()
+        self.write_metrics()
+        return report
+
+    def export_bundle(self, game_dir, bundle_path, compress=False):
+        """
+        Pack an installed game into a single bundle file that import_bundle()
+        can install from without the network. Every file is checked against
+        the installed manifest first, so only a verified game gets exported.
+        :param game_dir: Directory path to the game files.
+        :param bundle_path: Path of the bundle to write.
+        :param compress: LZMA-compress the files (on a pool of worker processes),
+                         keeping whichever of stored and compressed is smaller.
+        :raises BundleError: If there's no installed game or some of its files are broken.
+        """
+        game_manifest = self.load_installed_manifest(game_dir)
+        game_version = self.installed_version(game_dir)
+        if game_manifest is None or game_version is None:
+            raise bundle.BundleError(f"there is no installed game in {game_dir}")
+        index = self.compile_manifest(game_manifest)
+        files = [(os.path.join(game_dir, entry.path), entry) for entry in index.files]
+
+        self.metrics.start_run("export")
+        self.progress.start("export", files=index.file_count, hash=index.raw_bytes)
+        self.load_index(game_dir)
+        broken = []
+
+        def check(file_path, entry):
+            with self.metrics.file(file_path):
+                if self.check_file(file_path, entry) != "ok":
+                    with self.index_lock:
+                        broken.append(file_path)
+
+        try:
+            broken += [file_path for file_path, _ in self.run_concurrently(check, files, workers=os.cpu_count())]
+        finally:
+            self.save_index()
+        if broken:
+            raise bundle.BundleError(f"{len(broken)} files don't match the manifest, run Verify first")
+
+        self.progress.start("export", files=index.file_count)
+        locations = {}
+        tmp_path = bundle_path + ".tmp"
+        with open(tmp_path, "wb") as out:
+            out.write(bundle.MAGIC)
+
+            def append(src_path, entry, method):
+                with open(src_path, "rb") as src:
+                    offset = out.tell()
+                    shutil.copyfileobj(src, out, 1024 * 1024)
+                locations[entry.path] = [offset, out.tell() - offset, method]
+                self.progress.add(files=1)
+
+            if compress is True:
+                with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(bundle_path))) as work_dir, \
+                        concurrent.futures.ProcessPoolExecutor(max_workers=self.decompress_workers()) as pool:
+                    futures = {}
+                    for number, (file_path, entry) in enumerate(files):
+                        lzma_path = os.path.join(work_dir, str(number))
+                        futures[pool.submit(compress_worker, file_path, lzma_path)] = (file_path, lzma_path, entry)
+                    for future in concurrent.futures.as_completed(futures):
+                        file_path, lzma_path, entry = futures[future]
+                        if future.result() < entry.raw_size:
+                            append(lzma_path, entry, "lzma")
+                        else:
+                            append(file_path, entry, "stored")
+                        os.remove(lzma_path)
+            else:
+                for file_path, entry in files:
+                    append(file_path, entry, "stored")
+
+            manifest_data = json.dumps(game_manifest.data).encode()
+            manifest_offset = out.tell()
+            out.write(manifest_data)
+            bundle.write_index(out, {
+                "format": bundle.FORMAT,
+                "version": game_version,
+                "manifest": [manifest_offset, len(manifest_data)],
+                "files": locations,
+            })
+            size = out.tell()
+        os.replace(tmp_path, bundle_path)
+        self.progress.finish()
+        self.write_metrics()
+        print(f"BUNDLE {bundle_path} OK, {index.file_count} files, {size // (1024 * 1024)} MB")
+
+    def import_bundle(self, bundle_path, game_dir):
+        """
+        Install the game from a bundle made by export_bundle(). The bundle is
+        memory-mapped and the files are written straight out of the mapping
+        on a pool of threads. Like install(), the game is put together in a
+        staging directory and only swapped in for game_dir once every file
+        is in; files already in game_dir are carried over, and left alone if
+        they match the bundle's manifest. Everything written is checked
+        against it.
+        :param bundle_path: Path of the bundle.
+        :param game_dir: Directory path to install the game to.
+        :return: List of (file_path, entry) tuples that could not be imported.
+                 If there are any, game_dir is left as it was and the staging
+                 directory is kept, so importing again resumes.
+        :raises BundleError: If the bundle can't be read or has paths outside the game directory.
+        """
+        with open(bundle_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            info = bundle.read_index(mapped)
+            offset, length = info["manifest"]
+            manifest_data = mapped[offset:offset + length]
+            game_manifest = Manifest(json.loads(manifest_data), hashlib.sha1(manifest_data).hexdigest())
+            index = self.compile_manifest(game_manifest)
+            for path in index.dirs + [entry.path for entry in index.files]:
+                bundle.check_path(path)
+
+            self.recover_staging(game_dir)
+            staging_dir = self.staging_dir(game_dir)
+            os.makedirs(staging_dir, exist_ok=True)
+            if os.path.isdir(game_dir):
+                self.carry_over(game_dir, staging_dir, lambda path: True)
+            self.make_dirs(index.dirs, staging_dir)
+            self.metrics.start_run("import")
+            self.progress.start("import", files=index.file_count, hash=index.raw_bytes, decompress=sum(
+                entry.raw_size for entry in index.files if info["files"].get(entry.path, [0, 0, "stored"])[2] == "lzma"))
+            self.load_index(staging_dir)
+            self.load_store()
+            self.memory_budget = MemoryBudget(self.lzma_budget())
+            view = memoryview(mapped)
+            try:
+                failed = self.run_concurrently(
+                    lambda file_path, entry: self.import_file(view, info["files"], file_path, entry),
+                    [(os.path.join(staging_dir, entry.path), entry) for entry in index.files],
+                )
+            finally:
+                view.release()
+                self.save_index()
+                self.save_store()
+
+        if failed:
+            print(f"STAGING {len(failed)} files failed, {game_dir} is unchanged, import again to resume")
+        else:
+            self.save_installed_manifest(game_manifest, staging_dir)
+            self.swap_staging(staging_dir, game_dir, info["version"])
+        self.progress.finish()
+        self.write_metrics()
+        return failed
+
+    def write_metrics(self):
+        """
+        Write the per-file timings of the run that just finished to the
+        metrics_file (JSON lines) and prometheus_file, where configured.
+        """
+        try:
+            self.metrics.write(self.settings.get("metrics_file"), self.settings.get("prometheus_file"))
+        except OSError as e:
+            print(f"METRICS write failed ({e})")
+
+    def uninstall(self, game_dir, instant=False):
+        """
+        Delete the game directory and everything in it, along with any staged
+        install and whatever an earlier instant uninstall didn't get to.
+        :param game_dir: Directory path to the game files.
+        :param instant: Rename the directories out of the way and delete them
+                        on a background thread, so this returns right away.
+        """
+        staging_dir = self.staging_dir(game_dir)
+        if instant is not True:
+            self.empty_trash(game_dir)
+            if os.path.isdir(staging_dir):
+                self.delete_tree(staging_dir, False)
+            self.delete_tree(game_dir)
+            return
+
+        trash_dir = f"{os.path.normpath(game_dir)}.trash-{int(time.time() * 1000)}"
+        in_place = []
+        for path, trash_path in ((staging_dir, trash_dir + ".staging"), (game_dir, trash_dir)):
+            if path == staging_dir and not os.path.isdir(path):
+                continue
+            try:
+                os.rename(path, trash_path)
+            except OSError as e:
+                print(f"TRASH {path} failed ({e}), deleting in place")
+                in_place.append(path)
+            else:
+                print(f"TRASH {path} -> {trash_path}")
+        # the renamed directories are trash now, like any left over from before
+        threading.Thread(target=self.empty_trash, args=(game_dir,)).start()
+        for path in in_place:
+            self.delete_tree(path, path == game_dir)
+
+    def empty_trash(self, game_dir):
+        """
+        Delete the renamed game directories of instant uninstalls and swapped
+        out updates. One that can't be deleted is left for the next time.
+        :param game_dir: Directory path to the game files.
+        """
+        parent = os.path.dirname(os.path.abspath(game_dir))
+        prefix = os.path.basename(os.path.normpath(game_dir)) + ".trash-"
+        for entry in os.scandir(parent):
+            if entry.name.startswith(prefix) and entry.is_dir(follow_symlinks=False):
+                try:
+                    self.delete_tree(entry.path, False)
+                except OSError as e:
+                    print(f"TRASH {entry.path} failed ({e}), leaving it for the next uninstall")
+
+    def scan_tree(self, path):
+        """
+        List everything under a directory in a single os.scandir pass.
+        :param path: The directory.
+        :return: Tuple of (file paths, directory paths); parents come before their children.
+        """
+        files = []
+        dirs = []
+        pending = [path]
+        while pending:
+            with os.scandir(pending.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+                        pending.append(entry.path)
+                    else:
+                        files.append(entry.path)
+        return files, dirs
+
+    def delete_tree(self, path, report=True):
+        """
+        Delete a directory tree, removing the files on a pool of threads.
+        :param path: The directory.
+        :param report: Count the deleted files on self.progress.
+        """
+        files, dirs = self.scan_tree(path)
+        if report is True:
+            self.progress.start("uninstall", files=len(files))
+
+        def delete(file_path):
+            os.remove(file_path)
+            if report is True:
+                self.progress.add(files=1)
+
+        self.run_concurrently(delete, [(file_path,) for file_path in files], workers=min(32, (os.cpu_count() or 1) * 4))
+        # dirs lists parents first, so going backwards empties children first
+        for dir_path in reversed(dirs):
+            os.rmdir(dir_path)
+        os.rmdir(path)
+        print(f"RMTREE {path} OK")
+        if report is True:
+            self.progress.finish()
+
+    def load_installed_manifest(self, game_dir):
+        """
+        Load the manifest the game was last installed from.
+        :param game_dir: Directory path to the game files.
+        :return: The Manifest, or None if there isn't one.
+        """
+        manifest_path = os.path.join(game_dir, ".manifest.json")
+        if not os.path.exists(manifest_path):
+            return None
+        try:
+            with open(manifest_path, 'rb') as f:
+                data = f.read()
+            return Manifest(json.loads(data), hashlib.sha1(data).hexdigest())
+        except (OSError, ValueError):
+            print(f"MANIFEST {manifest_path} BAD, ignoring")
+            return None
+
+    def save_installed_manifest(self, game_manifest, game_dir):
+        """
+        Atomically save the manifest the game was installed from.
+        :param game_manifest: The game Manifest.
+        :param game_dir: Directory path to the game files.
+        """
+        manifest_path = os.path.join(game_dir, ".manifest.json")
+        with open(manifest_path + ".tmp", 'w') as f:
+            f.write(json.dumps(game_manifest.data))
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+    def compile_manifest(self, game_manifest):
+        """
+        Flatten a manifest into a ManifestIndex. The compiled index is cached
+        in the cache directory under the manifest's key, so a manifest that
+        was seen before is loaded straight from there instead of walked again.
+        :param game_manifest: The game Manifest.
+        :return: The ManifestIndex.
+        """
+        cache_dir = self.settings.get("cache_dir")
+        index_path = os.path.join(cache_dir, game_manifest.key + ".index") if cache_dir and game_manifest.key else None
+        if index_path is not None:
+            index = ManifestIndex.load(index_path)
+            if index is not None:
+                return index
+        index = ManifestIndex.compile(game_manifest.data["files"])
+        if index_path is not None:
+            try:
+                index.save(index_path)
+            except OSError as e:
+                print(f"MANIFEST can't cache the index ({e})")
+        return index
+
+    def diff_manifests(self, old_index, new_index):
+        """
+        Compare the files of two manifests by their SHA1.
+        :param old_index: ManifestIndex of the installed manifest.
+        :param new_index: ManifestIndex of the new manifest.
+        :return: Dict of "added", "changed", "removed" and "unchanged" lists of paths.
+                 Removed directories are included in "removed".
+        """
+        diff = {"added": [], "changed": [], "removed": [], "unchanged": []}
+        old_files = old_index.by_path()
+        new_files = new_index.by_path()
+        for path, entry in new_files.items():
+            old_entry = old_files.get(path)
+            if old_entry is None:
+                diff["added"].append(path)
+            elif old_entry.raw_sha1 != entry.raw_sha1:
+                diff["changed"].append(path)
+            else:
+                diff["unchanged"].append(path)
+        diff["removed"] += [path for path in old_files if path not in new_files]
+        new_dirs = set(new_index.dirs)
+        diff["removed"] += [path for path in old_index.dirs if path not in new_dirs]
+        return diff
+
+    def download_size(self, entry):
+        """
+        :param entry: A ManifestEntry.
+        :return: How many bytes installing the file downloads with the current settings.
+        """
+        return entry.download(self.settings["download_raw"])[2]
+
+    def decompress_size(self, entry):
+        """
+        :param entry: A ManifestEntry.
+        :return: How many bytes installing the file decompresses with the current settings.
+        """
+        return entry.raw_size if entry.download(self.settings["download_raw"])[3] else 0
+
+    def install_entries(self, index, entries, base_path):
+        """
+        Create the directories of the manifest, then download, verify and
+        decompress the given files on the pool of download threads.
+        :param index: The ManifestIndex being installed.
+        :param entries: The ManifestEntry of every file that needs installing.
+        :param base_path: The base directory to operate in.
+        :return: List of (file_path, entry) tuples that could not be installed.
+        """
+        self.make_dirs(index.dirs, base_path)
+        files = [(os.path.join(base_path, entry.path), entry) for entry in entries]
+        self.load_index(base_path)
+        self.load_store()
+        self.memory_budget = MemoryBudget(self.lzma_budget())
+        try:
+            return self.run_scheduled(self.install_file, files)
+        finally:
+            self.close_decompress_pool()
+            self.save_index()
+            self.save_store()
+
+    def make_dirs(self, dirs, base_path):
+        """
+        Create every directory of the manifest.
+        :param dirs: Directory paths from a ManifestIndex, parents first.
+        :param base_path: The base directory to operate in.
+        """
+        for path in dirs:
+            dir_path = os.path.join(base_path, path)
+            os.makedirs(dir_path, exist_ok=True)
+            print(f"MKDIR {dir_path}")
+
+    def run_concurrently(self, target, jobs, workers=None):
+        """
+        Run target(*job) for every job on a bounded pool of worker threads.
+        :param target: Function to call for each job.
+        :param jobs: List of argument tuples.
+        :param workers: Size of the pool, defaults to the download thread count.
+        :return: List of the jobs that raised an exception, for the caller to report.
+        """
+        workers = workers or int(self.settings.get("download_threads"))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            futures = {pool.submit(target, *job): job for job in jobs}
+            failed = []
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"FAIL {futures[future][0]}: {e}")
+                    failed.append(futures[future])
+        return failed
+
+    def run_scheduled(self, target, jobs):
+        """
+        Run target(file_path, entry) for every download job, in the order and
+        at the concurrency the DownloadScheduler picks, under the download_limit.
+        :param target: Function to call for each job.
+        :param jobs: List of (file_path, entry) tuples.
+        :return: List of the jobs that raised an exception.
+        """
+        self.scheduler = DownloadScheduler(int(self.settings.get("download_threads")))
+        self.scheduler.plan(jobs, lambda job: self.download_size(job[1]))
+        self.rate_limiter = RateLimiter(float(self.settings.get("download_limit") or 0) * 1024 * 1024)
+        self.dead_peers = set()
+        failed = []
+
+        def work(scheduler):
+            while (batch := scheduler.next_batch()) is not None:
+                try:
+                    for job in batch:
+                        try:
+                            target(*job)
+                        except Exception as e:
+                            print(f"FAIL {job[0]}: {e}")
+                            with self.index_lock:
+                                failed.append(job)
+                finally:
+                    scheduler.done()
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.scheduler.max_workers) as pool:
+                for future in [pool.submit(work, self.scheduler) for _ in range(self.scheduler.max_workers)]:
+                    future.result()
+        finally:
+            self.scheduler = None
+        return failed
+
+    def throttle(self, amount):
+        """
+        Account for amount freshly downloaded bytes: feed the scheduler's
+        throughput measurement and hold the thread back if we're over the
+        download_limit.
+        """
+        scheduler = self.scheduler
+        if scheduler is not None:
+            scheduler.count(amount)
+        self.rate_limiter.consume(amount)
+
+    def install_file(self, file_path, entry):
+        """
+        Download, verify and decompress a single file from the manifest.
+        :param file_path: Local path of the file.
+        :param entry: The ManifestEntry of the file.
+        """
+        with self.metrics.file(file_path):
+            if self.fetch_file(file_path, entry):
+                if self.journal is not None and entry.raw_sha1:
+                    self.journal.add(entry.path, entry.raw_sha1, file_path)
+                self.progress.add(files=1)
+
+    def fetch_file(self, file_path, entry):
+        """
+        Download a file from the manifest, verifying and decompressing it.
+        A download that fails its SHA1 check is thrown away and fetched again
+        from scratch once before giving up.
+        :param file_path: Local path of the file.
+        :param entry: The ManifestEntry of the file.
+        :return: True if the file was installed, False if the entry has nothing to download.
+        """
+        file_url, file_sha1, size, compressed = entry.download(self.settings["download_raw"])
+        if not file_url:
+            return False
+        raw_sha1 = entry.raw_sha1
+
+        if self.link_from_store(file_path, raw_sha1):
+            self.record_file(file_path, raw_sha1)
+            self.progress.skip(download=size, decompress=self.decompress_size(entry))
+            return True
+
+        if self.fetch_from_peers(file_path, entry):
+            self.record_file(file_path, raw_sha1)
+            self.add_to_store(file_path, raw_sha1)
+            # peers hand out the uncompressed file, so the planned totals are off by the difference
+            self.progress.skip(download=size - entry.raw_size, decompress=self.decompress_size(entry))
+            return True
+
+        # big files go through a .part file so an interrupted download can resume,
+        # which the single-pass streaming decompressor can't do
+        stream = compressed and self.settings["stream_lzma"] is True and size < self.resume_threshold
+
+        for attempt in range(2):
+            if stream:
+                ok = self.stream_file(file_url, file_path, file_sha1)
+            else:
+                ok = self.download_file(file_url, file_path, file_sha1)
+                if ok and compressed:
+                    self.decompress_file(file_path)
+            if ok:
+                self.record_file(file_path, raw_sha1)
+                self.add_to_store(file_path, raw_sha1)
+                return True
+        raise ValueError(f"SHA1 mismatch after {attempt + 1} attempts")
+
+    def fetch_from_peers(self, file_path, entry):
+        """
+        Try to get a file from the other launchers listed in "peers" before
+        going upstream. Peers serve the uncompressed file under its SHA1,
+        which is checked against the manifest like any other download.
+        A peer that can't be reached is skipped for the rest of the run.
+        :param file_path: Local path of the file.
+        :param entry: The ManifestEntry of the file.
+        :return: True if a peer had the file, False otherwise.
+        """
+        if not entry.raw_sha1:
+            return False
+        for peer in self.settings.get("peers") or []:
+            if peer in self.dead_peers:
+                continue
+            url = f"{peer.rstrip('/')}/{entry.raw_sha1.hex()}"
+            try:
+                if self.download_file(url, file_path, entry.raw_sha1, retries=0):
+                    print(f"PEER {file_path} OK from {peer}")
+                    return True
+            except (requests.ConnectionError, requests.Timeout) as e:
+                print(f"PEER {peer} unreachable ({e}), skipping it")
+                self.dead_peers.add(peer)
+            except (requests.RequestException, OSError) as e:
+                print(f"PEER {url} FAILED ({e})")
+        return False
+
+    def lzma_budget(self):
+        """
+        :return: The launcher-wide decompression memory budget in bytes.
+                 lzma_mem_cap is in the 2 MB steps the settings slider shows.
+        """
+        return int(self.settings.get("lzma_mem_cap")) * 2 * 1024 * 1024
+
+    def decompress_chunk(self):
+        """
+        :return: How many bytes of output a single decompress call may produce,
+                 so every worker can hold a chunk at once within the budget.
+        """
+        workers = self.decompress_workers()
+        return max(64 * 1024, min(16 * 1024 * 1024, self.lzma_budget() // (2 * workers)))
+
+    def decompress_workers(self):
+        return int(self.settings.get("decompress_workers")) or os.cpu_count() or 1
+
+    def get_decompress_pool(self):
+        """
+        Return the pool of worker processes that run the decompression stage,
+        creating it on first use.
+        """
+        with self.index_lock:
+            if self.decompress_pool is None:
+                self.decompress_pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.decompress_workers())
+            return self.decompress_pool
+
+    def close_decompress_pool(self):
+        if self.decompress_pool is not None:
+            self.decompress_pool.shutdown()
+            self.decompress_pool = None
+
+    def decompress_file(self, file_path):
+        """
+        Decompress an LZMA file in place on the decompression stage.
+        The decoder's dictionary plus one output chunk is reserved from the
+        memory budget for as long as the file is being decompressed.
+        :param file_path: The path to the compressed file.
+        """
+        tmp_path = file_path + ".tmp"
+        max_length = self.decompress_chunk()
+        with open(file_path, 'rb') as f:
+            header = f.read(13)
+        reserved = self.memory_budget.reserve(lzma_dict_size(header) + max_length)
+        try:
+            with self.metrics.time("decompress"):
+                written = self.get_decompress_pool().submit(decompress_worker, file_path, tmp_path, max_length).result()
+        finally:
+            self.memory_budget.release(reserved)
+        self.progress.add(decompressed=written)
+        with self.metrics.time("rename"):
+            os.replace(tmp_path, file_path)
+        print(f"LZMA {file_path} OK")
+
+    def get_session(self):
+        """
+        Return the shared HTTP session, creating it on first use.
+        The connection pool is sized to the download thread count so every
+        worker can keep its own keep-alive connection open.
+        """
+        if self.session is None:
+            threads = max(1, int(self.settings.get("download_threads")))
+            adapter = requests.adapters.HTTPAdapter(pool_connections=threads, pool_maxsize=threads)
+            adapter.poolmanager.pool_classes_by_scheme = metrics.timed_pools(self.metrics)
+            self.session = requests.Session()
+            self.session.mount("https://", adapter)
+            self.session.mount("http://", adapter)
+        return self.session
+
+    def with_retries(self, url, action, retries=3):
+        """
+        Call action(), retrying with exponential backoff if it fails.
+        :param url: The URL being fetched, used for logging.
+        :param action: Function doing the actual work.
+        :param retries: How many times to retry before giving up.
+        :return: Whatever action() returns.
+        """
+        for attempt in range(retries + 1):
+            try:
+                return action()
+            except (requests.RequestException, OSError, l.LZMAError) as e:
+                if attempt == retries:
+                    raise
+                print(f"GET {url} RETRY ({e})")
+                self.metrics.count(retries=1)
+                time.sleep(2 ** attempt)
+
+    def download_file(self, url, path, expected_sha1=None, retries=3):
+        """
+        Download a file from the given URL and save it to the specified path.
+        The data goes to a .part file with a small .part.json journal holding
+        the URL, how many bytes are safely on disk and their SHA1, so an
+        interrupted download picks up where it left off with a Range request.
+        :param url: The URL of the file to download.
+        :param path: The local path to save the file.
+        :param expected_sha1: The expected SHA1 digest (bytes) of the file, if known.
+        :param retries: How many times to retry a failed download before giving up.
+        :return: True if the checksum matches (or there is none), False otherwise.
+        """
+        part_path = path + ".part"
+        journal_path = path + ".part.json"
+        reached = None # how far into the file the bytes counted as downloaded go
+
+        def download():
+            nonlocal reached
+            offset, sha1 = self.resume_state(url, part_path, journal_path)
+            headers = {"Range": f"bytes={offset}-"} if offset else {}
+            with self.metrics.time("ttfb"):
+                response = self.get_session().get(url, stream=True, timeout=30, headers=headers)
+            # 416: the journal covers the whole file, we were stopped before the rename
+            complete = offset and response.status_code == 416
+            if not complete:
+                response.raise_for_status()
+            if offset and not complete and response.status_code != 206:
+                print(f"GET {url} can't resume, starting over")
+                offset, sha1 = 0, hashlib.sha1()
+            elif offset and not complete:
+                print(f"GET {url} resuming at {offset}")
+            if reached is None:
+                self.progress.skip(download=offset) # on disk from an earlier run
+            else:
+                self.progress.skip(download=offset - reached) # downloading counted bytes again
+            reached = offset
+            if complete:
+                response.close()
+                os.truncate(part_path, offset)
+                print(f"GET {url} already complete")
+                return sha1.digest()
+            journaled = offset
+            with self.metrics.time("transfer"), open(part_path, "r+b" if offset else "wb") as file:
+                file.seek(offset)
+                file.truncate()
+                for chunk in response.iter_content(chunk_size=65536):
+                    file.write(chunk)
+                    with self.metrics.time("hash"):
+                        sha1.update(chunk)
+                    self.metrics.count(hashed=len(chunk)) # metrics only, hashing isn't part of the install progress
+                    offset += len(chunk)
+                    reached = offset
+                    self.progress.add(downloaded=len(chunk))
+                    self.throttle(len(chunk))
+                    if offset - journaled >= 4 * 1024 * 1024:
+                        file.flush()
+                        self.write_journal(journal_path, url, offset, sha1)
+                        journaled = offset
+            print(f"GET {url} OK")
+            return sha1.digest()
+
+        calculated_sha1 = self.with_retries(url, download, retries)
+        if os.path.exists(journal_path):
+            os.remove(journal_path)
+        if expected_sha1 and expected_sha1 != calculated_sha1:
+            print(f"SHA1 {path} BAD")
+            os.remove(part_path)
+            return False
+        with self.metrics.time("rename"):
+            os.replace(part_path, path)
+        return True
+
+    def write_journal(self, journal_path, url, offset, sha1):
+        """
+        Record how much of a download is on disk.
+        :param journal_path: The path to the .part.json journal.
+        :param url: The URL being downloaded.
+        :param offset: How many bytes of the .part file are complete.
+        :param sha1: Running SHA1 of those bytes.
+        """
+        with open(journal_path + ".tmp", 'w') as f:
+            f.write(json.dumps({"url": url, "offset": offset, "sha1": sha1.hexdigest()}))
+        os.replace(journal_path + ".tmp", journal_path)
+
+    def resume_state(self, url, part_path, journal_path):
+        """
+        Work out where an interrupted download can resume from.
+        hashlib can't save a hash's internal state, so the journaled part of
+        the file is hashed again, which also checks it wasn't damaged.
+        :param url: The URL being downloaded.
+        :param part_path: The path to the .part file.
+        :param journal_path: The path to the .part.json journal.
+        :return: Tuple of (offset, sha1 object covering the first offset bytes).
+        """
+        sha1 = hashlib.sha1()
+        if not os.path.exists(journal_path) or not os.path.exists(part_path):
+            return 0, sha1
+        try:
+            with open(journal_path, 'r') as f:
+                journal = json.loads(f.read())
+        except (OSError, ValueError):
+            return 0, sha1
+        offset = journal.get("offset", 0)
+        if journal.get("url") != url or os.path.getsize(part_path) < offset:
+            return 0, sha1
+        with open(part_path, "rb") as file:
+            remaining = offset
+            while remaining and (chunk := file.read(min(remaining, 1024 * 1024))):
+                sha1.update(chunk)
+                remaining -= len(chunk)
+        if sha1.hexdigest() != journal.get("sha1"):
+            print(f"RESUME {part_path} BAD, starting over")
+            return 0, hashlib.sha1()
+        return offset, sha1
+
+    def stream_file(self, url, path, expected_sha1, retries=3):
+        """
+        Download an LZMA file, hashing and decompressing it as it arrives.
+        Only the decompressed output ever touches the disk. The decoder runs
+        on the download thread (it drops the GIL, so threads still spread
+        over cores) and holds a reservation on the memory budget like the
+        decompression stage does.
+        :param url: The URL of the compressed file.
+        :param path: The local path to save the decompressed file.
+        :param expected_sha1: The expected SHA1 digest (bytes) of the compressed file.
+        :param retries: How many times to retry a failed download before giving up.
+        :return: True if the checksum matches, False otherwise.
+        """
+        max_length = self.decompress_chunk()
+        tmp_path = path + ".tmp"
+        downloaded = decompressed = 0 # counted by the last attempt
+
+        def stream():
+            nonlocal downloaded, decompressed
+            # every attempt starts over, so what a failed one counted is done again
+            self.progress.skip(download=-downloaded, decompress=-decompressed)
+            downloaded = decompressed = 0
+            sha1 = hashlib.sha1()
+            decompressor = l.LZMADecompressor()
+            with self.metrics.time("ttfb"):
+                response = self.get_session().get(url, stream=True, timeout=30)
+            response.raise_for_status()
+            reserved = 0
+            try:
+                with self.metrics.time("transfer"), open(tmp_path, "wb") as file:
+                    for chunk in response.iter_content(chunk_size=65536):
+                        with self.metrics.time("hash"):
+                            sha1.update(chunk)
+                        self.metrics.count(hashed=len(chunk)) # metrics only, hashing isn't part of the install progress
+                        self.progress.add(downloaded=len(chunk))
+                        downloaded += len(chunk)
+                        self.throttle(len(chunk))
+                        if decompressor.eof:
+                            continue
+                        if not reserved:
+                            reserved = self.memory_budget.reserve(lzma_dict_size(chunk) + max_length)
+                        with self.metrics.time("decompress"):
+                            data = decompressor.decompress(chunk, max_length)
+                        file.write(data)
+                        self.progress.add(decompressed=len(data))
+                        decompressed += len(data)
+                        while not decompressor.needs_input and not decompressor.eof:
+                            with self.metrics.time("decompress"):
+                                data = decompressor.decompress(b"", max_length)
+                            file.write(data)
+                            self.progress.add(decompressed=len(data))
+                            decompressed += len(data)
+            finally:
+                if reserved:
+                    self.memory_budget.release(reserved)
+            return sha1.digest()
+
+        calculated_sha1 = self.with_retries(url, stream, retries)
+        if expected_sha1 and expected_sha1 != calculated_sha1:
+            print(f"SHA1 {path} BAD")
+            os.remove(tmp_path)
+            return False
+        with self.metrics.time("rename"):
+            os.replace(tmp_path, path)
+        print(f"GET+LZMA {path} OK")
+        return True
+
+    def load_index(self, game_dir):
+        """
+        Load the file-state index of a game directory.
+        The index maps every installed file to the size, mtime and inode it
+        had when its SHA1 was last verified, so unchanged files can skip hashing.
+        :param game_dir: Directory path to the game files.
+        """
+        self.index_dir = game_dir
+        self.file_index = {}
+        index_path = os.path.join(game_dir, ".index.json")
+        if os.path.exists(index_path):
+            try:
+                with open(index_path, 'r') as f:
+                    self.file_index = json.loads(f.read())
+            except (OSError, ValueError):
+                print(f"INDEX {index_path} BAD, ignoring")
+
+    def save_index(self):
+        """
+        Atomically write the file-state index back to the game directory.
+        """
+        if not os.path.isdir(self.index_dir):
+            return
+        index_path = os.path.join(self.index_dir, ".index.json")
+        with self.index_lock:
+            data = json.dumps(self.file_index)
+        with open(index_path + ".tmp", 'w') as f:
+            f.write(data)
+        os.replace(index_path + ".tmp", index_path)
+
+    def record_file(self, file_path, sha1):
+        """
+        Remember that a file on disk has been verified to have the given SHA1.
+        :param file_path: The path to the file.
+        :param sha1: The verified SHA1 digest (bytes) of the file's contents.
+        """
+        if not sha1:
+            return
+        st = os.stat(file_path)
+        with self.index_lock:
+            self.file_index[os.path.relpath(file_path, self.index_dir)] = {
+                "size": st.st_size, "mtime": st.st_mtime_ns, "inode": st.st_ino, "sha1": sha1.hex()
+            }
+
+    def is_unchanged(self, file_path, sha1):
+        """
+        Check the index to see if a file is still the one that was last verified.
+        :param file_path: The path to the file.
+        :param sha1: The SHA1 digest (bytes) the file is expected to have.
+        :return: True if the file's stat data matches its index entry, False otherwise.
+        """
+        with self.index_lock:
+            entry = self.file_index.get(os.path.relpath(file_path, self.index_dir))
+        if entry is None or entry["sha1"] != sha1.hex():
+            return False
+        st = os.stat(file_path)
+        return (entry["size"], entry["mtime"], entry["inode"]) == (st.st_size, st.st_mtime_ns, st.st_ino)
+
+    def load_store(self):
+        """
+        Open the shared object store, if one is configured.
+        The store keeps one copy of every installed file, named by its SHA1,
+        so other game directories on the machine can hardlink to it instead
+        of downloading. .lru.json remembers when each object was last used.
+        """
+        self.store_dir = self.settings.get("object_store") or None
+        self.store_lru = {}
+        if self.store_dir is None:
+            return
+        os.makedirs(self.store_dir, exist_ok=True)
+        lru_path = os.path.join(self.store_dir, ".lru.json")
+        if os.path.exists(lru_path):
+            try:
+                with open(lru_path, 'r') as f:
+                    self.store_lru = json.loads(f.read())
+            except (OSError, ValueError):
+                print(f"STORE {lru_path} BAD, ignoring")
+
+    def save_store(self):
+        """
+        Evict the least recently used objects until the store fits its size
+        cap, then atomically write back the usage times. Other launchers may
+        be using the store at the same time, so their usage times are merged
+        in first and objects they evict from under us are skipped.
+        """
+        if self.store_dir is None:
+            return
+        lru_path = os.path.join(self.store_dir, ".lru.json")
+        try:
+            with open(lru_path, 'r') as f:
+                on_disk = json.loads(f.read())
+        except (OSError, ValueError):
+            on_disk = {}
+        with self.index_lock:
+            for name, used in on_disk.items():
+                self.store_lru[name] = max(used, self.store_lru.get(name, 0))
+
+        cap = int(self.settings.get("object_store_cap")) * 1024 * 1024 * 1024
+        objects = []
+        total = 0
+        for prefix in os.scandir(self.store_dir):
+            if not prefix.is_dir():
+                continue
+            for entry in os.scandir(prefix.path):
+                if entry.name.endswith(".tmp"):
+                    continue # another launcher's object on its way in
+                try:
+                    size = entry.stat().st_size
+                except FileNotFoundError:
+                    continue
+                objects.append((self.store_lru.get(entry.name, 0), entry.name, entry.path, size))
+                total += size
+        for _, sha1, path, size in sorted(objects):
+            if total <= cap:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass # evicted by another launcher
+            with self.index_lock:
+                self.store_lru.pop(sha1, None)
+            total -= size
+            print(f"STORE evicted {sha1}")
+
+        with self.index_lock:
+            data = json.dumps(self.store_lru)
+        replace_file(lru_path, data.encode())
+
+    def store_path(self, sha1):
+        """
+        :param sha1: SHA1 digest (bytes) of an object.
+        :return: Where the object lives in the store.
+        """
+        name = sha1.hex()
+        return os.path.join(self.store_dir, name[:2], name)
+
+    def link_file(self, src, dst):
+        """
+        Atomically make dst a hardlink to src, or a copy if hardlinks aren't
+        possible (e.g. across filesystems). shutil.copyfile uses the kernel's
+        in-place copy where it can. The temporary link gets a unique name, as
+        launchers sharing an object store may link the same object at once.
+        :param src: Existing file.
+        :param dst: Path to create.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dst) or ".", prefix=os.path.basename(dst) + ".", suffix=".tmp")
+        os.close(fd)
+        try:
+            try:
+                os.remove(tmp_path) # os.link won't replace it
+                os.link(src, tmp_path)
+            except OSError:
+                shutil.copyfile(src, tmp_path)
+            os.replace(tmp_path, dst)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def link_from_store(self, file_path, sha1):
+        """
+        Install a file from the shared object store. Objects are hardlinked
+        into every install, so editing any installed copy in place changes
+        the object too; it's rehashed before every use for that reason.
+        :param file_path: Local path of the file.
+        :param sha1: SHA1 digest (bytes) of the uncompressed file.
+        :return: True if the file was installed from the store, False otherwise.
+        """
+        if self.store_dir is None or not sha1:
+            return False
+        object_path = self.store_path(sha1)
+        if not os.path.exists(object_path):
+            return False
+        try:
+            if not self.verify_sha1(object_path, sha1):
+                print(f"STORE {sha1.hex()} BAD, dropping it")
+                os.remove(object_path)
+                return False
+            self.link_file(object_path, file_path)
+        except FileNotFoundError:
+            return False # evicted by another launcher in the meantime
+        with self.index_lock:
+            self.store_lru[sha1.hex()] = time.time()
+        print(f"STORE {file_path} OK")
+        return True
+
+    def add_to_store(self, file_path, sha1):
+        """
+        Put a freshly installed file into the shared object store.
+        :param file_path: Local path of the file.
+        :param sha1: Verified SHA1 digest (bytes) of the file.
+        """
+        if self.store_dir is None or not sha1:
+            return
+        object_path = self.store_path(sha1)
+        if not os.path.exists(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            try:
+                os.link(file_path, object_path)
+            except FileExistsError:
+                pass # another launcher added it first, same contents
+            except OSError:
+                self.link_file(file_path, object_path)
+        with self.index_lock:
+            self.store_lru[sha1.hex()] = time.time()
+
+    def verify_sha1(self, file_path, expected_sha1):
+        """
+        Verify the SHA1 checksum of a file.
+        Files of 1 MiB and up are memory-mapped and hashed in one call, which
+        avoids a read() and a new bytes object per chunk and lets hashlib
+        drop the GIL for the whole file.
+        :param file_path: The path to the file to verify.
+        :param expected_sha1: The expected SHA1 digest (bytes).
+        :return: True if the checksum matches, False otherwise.
+        """
+        with self.metrics.time("hash"), open(file_path, "rb") as file:
+            size = os.fstat(file.fileno()).st_size
+            if size >= 1024 * 1024:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    sha1 = hashlib.sha1(mapped)
+            else:
+                sha1 = hashlib.sha1(file.read())
+        self.progress.add(hashed=size)
+        return expected_sha1 == sha1.digest()
+
+    def verify_entries(self, index, base_path, deep=False):
+        """
+        Check every file of the manifest and repair the broken and missing ones.
+        :param index: The ManifestIndex to verify against.
+        :param base_path: The base directory to operate in.
+        :param deep: Rehash files even if the index says they haven't changed.
+        :return: The verify report, see verify_report(), plus a "failed" list
+                 of the (file_path, entry) tuples that couldn't be repaired.
+        """
+        self.make_dirs(index.dirs, base_path)
+        files = [(os.path.join(base_path, entry.path), entry) for entry in index.files]
+        self.load_index(base_path)
+        self.load_store()
+        self.memory_budget = MemoryBudget(self.lzma_budget())
+        try:
+            report = self.verify_report(files, base_path, deep)
+            print(f"VERIFY {len(report['ok'])} ok, {len(report['mismatched'])} mismatched, {len(report['missing'])} missing, {len(report['extra'])} extra")
+            for path in report["extra"]:
+                print(f"EXTRA {path}")
+            report["failed"] = self.run_scheduled(self.repair_file, report["mismatched"] + report["missing"])
+            if report["failed"]:
+                print(f"FAIL {len(report['failed'])} files could not be repaired, run Verify to retry them")
+            return report
+        finally:
+            self.close_decompress_pool()
+            self.save_index()
+            self.save_store()
+
+    def verify_report(self, files, base_path, deep=False):
+        """
+        Check every installed file against the manifest, hashing on one
+        thread per CPU core.
+        :param files: List of (file_path, ManifestEntry) tuples.
+        :param base_path: The base directory to operate in.
+        :param deep: Rehash files even if the index says they haven't changed.
+        :return: Dict of "ok", "mismatched" and "missing" lists of (file_path, entry)
+                 tuples, and an "extra" list of files on disk the manifest doesn't know.
+        """
+        report = {"ok": [], "mismatched": [], "missing": []}
+
+        def check(file_path, entry):
+            with self.metrics.file(file_path):
+                status = self.check_file(file_path, entry, deep)
+            with self.index_lock:
+                report[status].append((file_path, entry))
+            if status == "ok":
+                self.progress.add(files=1)
+
+        # a file that can't even be checked (unreadable, a directory in its
+        # place...) gets repaired like a broken one
+        report["mismatched"] += self.run_concurrently(check, files, workers=os.cpu_count())
+        report["extra"] = self.find_extra_files(files, base_path)
+        return report
+
+    def check_file(self, file_path, entry, deep=False):
+        """
+        Check a single installed file.
+        :param file_path: Local path of the file.
+        :param entry: The ManifestEntry of the file.
+        :param deep: Rehash the file even if the index says it hasn't changed.
+        :return: "ok", "mismatched" or "missing".
+        """
+        if not os.path.exists(file_path):
+            print(f"MISSING {file_path}")
+            return "missing"
+
+        file_sha1 = entry.raw_sha1
+        if not file_sha1:
+            return "ok"
+        if deep is False and self.is_unchanged(file_path, file_sha1):
+            print(f"SHA1 {file_path} UNCHANGED")
+            self.progress.skip(hash=entry.raw_size)
+            return "ok"
+        if self.verify_sha1(file_path, file_sha1):
+            print(f"SHA1 {file_path} OK")
+            self.record_file(file_path, file_sha1)
+            return "ok"
+        print(f"SHA1 {file_path} BAD")
+        return "mismatched"
+
+    def repair_file(self, file_path, entry):
+        """
+        Replace a missing or broken file.
+        :param file_path: Local path of the file.
+        :param entry: The ManifestEntry of the file.
+        :raises ValueError: If the replacement doesn't match the manifest either.
+        """
+        with self.metrics.file(file_path):
+            if not os.path.exists(file_path):
+                if self.fetch_file(file_path, entry):
+                    self.progress.add(files=1)
+                return
+
+            file_url = entry.raw_url
+            file_sha1 = entry.raw_sha1
+            if not (self.link_from_store(file_path, file_sha1) or self.fetch_from_peers(file_path, entry) or self.download_file(file_url, file_path, file_sha1)):
+                raise ValueError("SHA1 mismatch after repair")
+            self.record_file(file_path, file_sha1)
+            self.add_to_store(file_path, file_sha1)
+            self.progress.add(files=1)
+
+    def import_file(self, view, locations, file_path, entry):
+        """
+        Write a single file out of a memory-mapped bundle.
+        :param view: memoryview of the whole bundle; slices of it don't copy.
+        :param locations: The "files" of the bundle index.
+        :param file_path: Local path of the file.
+        :param entry: The ManifestEntry of the file.
+        """
+        with self.metrics.file(file_path):
+            if entry.path not in locations:
+                raise ValueError("not in the bundle")
+            offset, length, method = locations[entry.path]
+            if os.path.exists(file_path):
+                if self.check_file(file_path, entry) == "ok":
+                    self.progress.skip(decompress=entry.raw_size if method == "lzma" else 0)
+                    self.progress.add(files=1)
+                    return
+                self.progress.skip(hash=-entry.raw_size) # hashed again as it's rewritten
+            tmp_path = file_path + ".tmp"
+            sha1 = hashlib.sha1()
+            with view[offset:offset + length] as payload, open(tmp_path, "wb") as out:
+                if method == "stored":
+                    with self.metrics.time("hash"):
+                        sha1.update(payload)
+                    out.write(payload)
+                    self.progress.add(hashed=length)
+                else:
+                    self.unpack_lzma(payload, out, sha1)
+            if sha1.digest() != entry.raw_sha1:
+                os.remove(tmp_path)
+                raise ValueError("SHA1 mismatch")
+            with self.metrics.time("rename"):
+                os.replace(tmp_path, file_path)
+            self.record_file(file_path, entry.raw_sha1)
+            self.add_to_store(file_path, entry.raw_sha1)
+            print(f"UNPACK {file_path} OK")
+            self.progress.add(files=1)
+
+    def unpack_lzma(self, payload, out, sha1):
+        """
+        Decompress an LZMA payload of a bundle into out, hashing the output.
+        Runs on the calling thread (lzma drops the GIL) under a reservation
+        on the memory budget.
+        :param payload: memoryview of the compressed data.
+        :param out: File to write to.
+        :param sha1: Hash object to update with the decompressed data.
+        """
+        max_length = self.decompress_chunk()
+        reserved = self.memory_budget.reserve(lzma_dict_size(bytes(payload[:13])) + max_length)
+        try:
+            decompressor = l.LZMADecompressor()
+            position = 0
+            while not decompressor.eof:
+                if decompressor.needs_input:
+                    if position >= len(payload):
+                        break
+                    with payload[position:position + 1024 * 1024] as chunk, self.metrics.time("decompress"):
+                        data = decompressor.decompress(chunk, max_length)
+                    position += 1024 * 1024
+                else:
+                    with self.metrics.time("decompress"):
+                        data = decompressor.decompress(b"", max_length)
+                with self.metrics.time("hash"):
+                    sha1.update(data)
+                out.write(data)
+                self.progress.add(decompressed=len(data), hashed=len(data))
+        finally:
+            self.memory_budget.release(reserved)
+
+    def find_extra_files(self, files, base_path):
+        """
+        Find files in the game directory that aren't in the manifest.
+        The launcher's own dotfiles at the top of the directory are left out.
+        :param files: List of (file_path, ManifestEntry) tuples.
+        :param base_path: The base directory to operate in.
+        :return: List of paths relative to base_path.
+        """
+        known = {os.path.normpath(file_path) for file_path, _ in files}
+        extra = []
+        for root, dirs, names in os.walk(base_path):
+            for name in names:
+                path = os.path.join(root, name)
+                if root == base_path and name.startswith("."):
+                    continue
+                if os.path.normpath(path) not in known:
+                    extra.append(os.path.relpath(path, base_path))
+        return extra
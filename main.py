@@ -1,10 +1,8 @@
 import os
-import json
 import toga
-import hashlib
-import requests
+import asyncio
+import launcher
 import threading
-import lzma as l # TODO: the game manifest has {"lzma":{"url":"whatever"}} for compressed files, have to either fix that or do this
 import subprocess
 from datetime import datetime
 from toga.style.pack import * 
@@ -15,37 +13,33 @@ class PistonLauncher(toga.App):
         Wrapper for install_game()
         """
 
-        # TODO: make not hardcoded. will be hard since the random string at
-        # the beginning of each file is the hash of that file, and i haven't
-        # found a manifest 1 level higher than this
-
-        response = requests.get("https://piston-meta.mojang.com/v1/products/dungeons/f4c685912beb55eb2d5c9e0713fe1195164bba27/windows-x64.json")
-
         try:
-            game_manifest = response.json()["dungeons"][0]["manifest"]["url"]
-            game_version = response.json()["dungeons"][0]["version"]["name"]
+            game_manifest, game_version = await self.loop.run_in_executor(None, self.launcher.fetch_latest)
+        except launcher.OfflineError:
+            dialog = toga.ErrorDialog(title="Error!", message="Couldn't reach piston-meta and there's no cached manifest to install from.")
+            await self.dialog(dialog)
+            return
         except Exception:
             dialog = toga.ErrorDialog(title="Fatal Error!", message=f"Mojang has updated the game after {datetime.now().year - 2022} years!\nI haven't expected this, so the launcher doesn't support this yet.\nMake an issue on https://github.com/kenziewebm/piston-launcher!")
             await self.dialog(dialog)
             self.app.exit()
 
+        self.game_version = game_version
         game_dir = self.settings.get("game_dir")
 
-        if not os.path.exists(game_dir):
-            os.mkdir(game_dir)
-
-        with open(os.path.join(game_dir, ".version"), 'w') as f:
-            f.write(game_version)
-
-        response = requests.get(game_manifest)
-        self.loop.call_soon_threadsafe(self.set_max_progress, (len(response.json()["files"].keys())))
-
-        install_thread = threading.Thread(target=self.install_game, args=(response.json()["files"], game_dir))
+        install_thread = threading.Thread(target=self.install_game, args=(game_manifest, game_dir))
         self.loop.call_soon_threadsafe(self.set_dlbox_visibility, True)
         install_thread.start()
         self.set_button_state(False)
         self.set_button_text("Installing...")
         
+    async def update_wrapper(self, widget):
+        """
+        Update an existing install to the latest manifest.
+        """
+        widget.window.close()
+        await self.install_wrapper()
+
     def launch_game(self, game_exec):
         """
         Launch Minecraft: Dungeons
@@ -67,89 +61,50 @@ class PistonLauncher(toga.App):
     def install_game(self, game_manifest, game_dir):
         """
         Proceed with installation of Minecraft Dungeons
+        :param game_manifest: The game manifest to install from.
         :param game_dir: Directory path to install the game to.
         """
 
-        self.process_json(game_manifest, game_dir)
-        
+        try:
+            failed = self.launcher.install(game_manifest, game_dir, self.game_version)
+        except OSError as e:
+            failed = e
+        if failed:
+            asyncio.run_coroutine_threadsafe(self.install_failed(failed), self.loop)
+            return
+
         self.loop.call_soon_threadsafe(self.set_button_state, True)
         self.loop.call_soon_threadsafe(self.set_button_text, "Play")
         self.loop.call_soon_threadsafe(self.set_button_action, lambda button: self.launch_wrapper())
         self.loop.call_soon_threadsafe(self.set_dlbox_visibility, False)
         self.loop.call_soon_threadsafe(self.set_game_version, self.game_version)
+        self.loop.call_soon_threadsafe(self.start_sharing)
 
-    def process_json(self, json_data, base_path):
+    async def install_failed(self, failed):
         """
-        Process the JSON structure to create directories, download files, and set executables.
-        :param json_data: The JSON data to process.
-        :param base_path: The base directory to operate in.
+        Tell the user an install didn't finish; the game directory was left
+        alone and pressing the button again resumes from where it stopped.
+        :param failed: The files that failed, or the error that stopped the install.
         """
-        for key, value in json_data.items():
-            if isinstance(value, dict):
-                item_type = value.get("type")
-
-                if item_type == "directory":
-                    dir_path = os.path.join(base_path, key)
-                    os.makedirs(dir_path, exist_ok=True)
-                    print(f"MKDIR {dir_path}")
-                    self.loop.call_soon_threadsafe(self.update_progress)
-
-                    self.process_json(json_data=value, base_path=base_path) # yay, recursion!
-
-                elif item_type == "file":
-                    downloads = value.get("downloads", {})
-                    lzma = downloads.get("lzma")
-                    raw = downloads.get("raw")
-
-                    download_info = lzma if lzma and self.settings["download_raw"] is False else raw
-                    if download_info:
-                        file_url = download_info.get("url")
-                        file_sha1 = download_info.get("sha1")
-                        file_path = os.path.join(base_path, key)
-
-                        self.download_file(file_url, file_path)
-
-                        if file_sha1:
-                            print(f"SHA1 {file_path} ", end='')
-                            if self.verify_sha1(file_path, file_sha1):
-                                print(" OK")
-                            else:
-                                print(" BAD")
-                                os.remove(file_path)
-                                continue
-
-                        if lzma and self.settings["download_raw"] is False:
-                            chunk_size = self.settings.get("lzma_mem_cap")
-                            print(f"LZMA {file_path} ", end='')
-                            tmp_path = file_path + ".tmp"
-                            with l.open(file_path, 'rb') as cf:
-                                with open(tmp_path, 'wb') as f:
-                                    if chunk_size == 0:
-                                        f.write(cf.read())
-                                    else:
-                                        while True:
-                                            chunk = cf.read(1024 * 1024 * chunk_size)
-                                            if not chunk:
-                                                break
-                                            f.write(chunk)
-                            os.replace(tmp_path, file_path)
-                            print("OK")
-
-                        self.loop.call_soon_threadsafe(self.update_progress)
+        if isinstance(failed, Exception):
+            message = f"The install couldn't be finished ({failed}).\nPress the button to try again, it will pick up where it left off."
+        else:
+            message = f"{len(failed)} files couldn't be downloaded.\nPress the button to try again, it will pick up where it left off."
+        self.set_dlbox_visibility(False)
+        self.set_button_state(True)
+        self.set_button_text("Resume install")
+        self.set_button_action(self.install_wrapper)
+        await self.dialog(toga.ErrorDialog(title="Error!", message=message))
 
     # im pretty sure that theres a much smarter way to do this
     # than making 5 billion tiny functions, but i cant come up
     # with anything with anything better. all of these return
     # "True" so that they can work as OnCloseHandler()s for windows
 
-    def update_progress(self):
-        self.bar.value += 1
-        self.items.text = f"{int(self.bar.value)}/{int(self.bar.max)}"
-        return True
-
-    def set_max_progress(self, max):
-        self.bar.max = int(max)
-        self.bar.value = 0
+    def show_progress(self, snapshot):
+        self.bar.max = 1000
+        self.bar.value = int(snapshot["fraction"] * 1000)
+        self.items.text = launcher.format_progress(snapshot)
         return True
 
     def set_button_text(self, text):
@@ -176,8 +131,18 @@ class PistonLauncher(toga.App):
         self.keep_settings_disabled = True if state is False else False
         self.uninstall_game_button.enabled = state
         self.verify_files_button.enabled = state
+        self.deep_verify_button.enabled = state
+        self.update_game_button.enabled = state
         self.raw_checkbox.enabled = state
+        self.stream_checkbox.enabled = state
+        self.offline_checkbox.enabled = state
+        self.share_checkbox.enabled = state
+        self.peers_input.enabled = state
         self.lzma_slider.enabled = state
+        self.threads_input.enabled = state
+        self.limit_input.enabled = state
+        self.store_input.enabled = state
+        self.store_cap_input.enabled = state
         self.game_dir_input.enabled = state
         return True
 
@@ -191,50 +156,40 @@ class PistonLauncher(toga.App):
         self.bar.style.visibility = VISIBLE if state is True else HIDDEN
         self.items.style.visibility = VISIBLE if state is True else HIDDEN
 
-    def download_file(self, url, path):
-        """
-        Download a file from the given URL and save it to the specified path.
-        :param url: The URL of the file to download.
-        :param path: The local path to save the file.
-        """
-        print(f"GET {url} ", end='')
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
-        with open(path, "wb") as file:
-            for chunk in response.iter_content(chunk_size=8192):
-                file.write(chunk)
-        print("OK")
-
-    def verify_sha1(self, file_path, expected_sha1):
-        """
-        Verify the SHA1 checksum of a file.
-        :param file_path: The path to the file to verify.
-        :param expected_sha1: The expected SHA1 checksum.
-        :return: True if the checksum matches, False otherwise.
-        """
-        sha1 = hashlib.sha1()
-        with open(file_path, "rb") as file:
-            while chunk := file.read(8192):
-                sha1.update(chunk)
-        calculated_sha1 = sha1.hexdigest()
-        return expected_sha1 == calculated_sha1
-    
     def open_settings_window(self, widget):
 
         self.set_button_state(False)
 
-        self.settings_window = toga.Window(title="Settings", size=(500, 250), resizable=False, on_close=lambda window: self.set_button_state(True))
+        self.settings_window = toga.Window(title="Settings", size=(500, 620), resizable=False, on_close=lambda window: self.set_button_state(True))
         settings_box = toga.Box()
 
         game_dir_label = toga.Label("Game Directory")
         self.game_dir_input = toga.TextInput(placeholder="Game files path", value=self.settings["game_dir"])
 
         self.lzma_slider_label = toga.Label("LZMA Memory Cap: " + str(int(self.settings["lzma_mem_cap"]) * 2) + " MB")
-        self.lzma_slider = toga.Slider(min=0, max=1024, value=self.settings["lzma_mem_cap"], on_change=self.update_lzma_slider_text, tick_count=9)
+        self.lzma_slider = toga.Slider(min=1, max=1024, value=self.settings["lzma_mem_cap"], on_change=self.update_lzma_slider_text, tick_count=9)
+
+        self.threads_label = toga.Label("Download threads")
+        self.threads_input = toga.NumberInput(min=1, max=64, value=self.settings["download_threads"])
+
+        limit_label = toga.Label("Download speed limit in MB/s (0 = unlimited)")
+        self.limit_input = toga.NumberInput(min=0, max=10000, step=0.5, value=self.settings["download_limit"])
+
+        store_label = toga.Label("Shared object store (empty to disable) and its size cap in GB")
+        self.store_input = toga.TextInput(placeholder="Object store path", value=self.settings["object_store"])
+        self.store_cap_input = toga.NumberInput(min=1, max=1024, value=self.settings["object_store_cap"])
 
         self.raw_checkbox = toga.Switch("Download uncompressed files", on_change=self.toggle_slider, value=self.settings["download_raw"])
+        self.stream_checkbox = toga.Switch("Decompress while downloading", value=self.settings["stream_lzma"])
+        self.offline_checkbox = toga.Switch("Offline mode (use cached manifests)", value=self.settings["offline"])
+        self.share_checkbox = toga.Switch("Share game files with launchers on the LAN", value=self.settings["share_files"])
+
+        peers_label = toga.Label("LAN peers to download from (comma separated URLs)")
+        self.peers_input = toga.TextInput(placeholder="http://192.168.1.10:8625", value=", ".join(self.settings["peers"]))
 
         self.verify_files_button = toga.Button("Verify game installation", on_press=self.verify_files_wrapper)
+        self.deep_verify_button = toga.Button("Deep verify (rehash every file)", on_press=self.verify_files_wrapper)
+        self.update_game_button = toga.Button("Update game", on_press=self.update_wrapper)
         self.uninstall_game_button = toga.Button("Uninstall game", on_press=self.uninstall_game_wrapper)
 
         save_button = toga.Button("Save", on_press=self.save_settings)
@@ -243,13 +198,29 @@ class PistonLauncher(toga.App):
         settings_box.add(self.game_dir_input)
         settings_box.add(self.lzma_slider_label)
         settings_box.add(self.lzma_slider)
+        settings_box.add(self.threads_label)
+        settings_box.add(self.threads_input)
+        settings_box.add(limit_label)
+        settings_box.add(self.limit_input)
+        settings_box.add(store_label)
+        settings_box.add(self.store_input)
+        settings_box.add(self.store_cap_input)
         settings_box.add(self.raw_checkbox)
+        settings_box.add(self.stream_checkbox)
+        settings_box.add(self.offline_checkbox)
+        settings_box.add(self.share_checkbox)
+        settings_box.add(peers_label)
+        settings_box.add(self.peers_input)
         settings_box.add(self.verify_files_button)
+        settings_box.add(self.deep_verify_button)
+        settings_box.add(self.update_game_button)
         settings_box.add(self.uninstall_game_button)
         settings_box.add(save_button)
 
         if os.path.exists(os.path.join(self.settings.get("game_dir"), ".version")) is False:
             self.verify_files_button.enabled = False
+            self.deep_verify_button.enabled = False
+            self.update_game_button.enabled = False
             self.uninstall_game_button.enabled = False
 
         self.toggle_slider(None)
@@ -266,10 +237,7 @@ class PistonLauncher(toga.App):
         self.settings_window.show()
 
     def update_lzma_slider_text(self, widget):
-        if self.lzma_slider.value != 0:
-            self.lzma_slider_label.text = "LZMA Memory Cap: " + str(int(self.lzma_slider.value) * 2) + " MB"
-        else:
-            self.lzma_slider_label.text = "LZMA Memory Cap: Uncapped"
+        self.lzma_slider_label.text = "LZMA Memory Cap: " + str(int(self.lzma_slider.value) * 2) + " MB"
 
     async def uninstall_game_wrapper(self, widget):
         confirm_dialog = toga.ConfirmDialog(title="Piston Launcher", message="Are you sure you want to uninstall Minecraft: Dungeons?")
@@ -282,48 +250,41 @@ class PistonLauncher(toga.App):
         widget.window.close()
 
     def uninstall_game(self):
-        game_dir = self.settings.get("game_dir")
-        file_count = sum(len(files) for _, _, files in os.walk(game_dir)) # beautiful
-        self.loop.call_soon_threadsafe(self.set_max_progress, file_count + 1)
-        for root, dirs, files in os.walk(game_dir, topdown=False):
-            for file in files:
-                file_path = os.path.join(root, file)
-                os.remove(file_path)
-            for dir in dirs:
-                dir_path = os.path.join(root, dir)
-                os.rmdir(dir_path)
-            self.loop.call_soon_threadsafe(self.update_progress)
-        os.rmdir(game_dir)
-        self.loop.call_soon_threadsafe(self.update_progress)
+        self.launcher.uninstall(self.settings.get("game_dir"), instant=True)
         self.loop.call_soon_threadsafe(self.set_button_state, True)
         self.loop.call_soon_threadsafe(self.set_button_text, "Install")
         self.loop.call_soon_threadsafe(self.set_dlbox_visibility, False)
         self.loop.call_soon_threadsafe(self.set_button_action, self.install_wrapper)
         self.loop.call_soon_threadsafe(self.set_game_version, "Not installed                        ")
+        self.loop.call_soon_threadsafe(self.start_sharing) # stops sharing now that there's nothing to share
 
     async def verify_files_wrapper(self, widget):
         self.set_button_state(False)
         self.set_button_text("Verifying")
         self.set_dlbox_visibility(True)
         self.toggle_settings_state(False)
-        index_manifest = "https://piston-meta.mojang.com/v1/products/dungeons/f4c685912beb55eb2d5c9e0713fe1195164bba27/windows-x64.json"
-        response = requests.get(index_manifest)
         try:
-            game_manifest = response.json()["dungeons"][0]["manifest"]["url"]
-            response = requests.get(game_manifest)
-            print(response.json())
+            game_manifest, _ = await self.loop.run_in_executor(None, self.launcher.fetch_latest, self.settings.get("game_dir"))
+        except launcher.OfflineError:
+            dialog = toga.ErrorDialog(title="Error!", message="Couldn't reach piston-meta and there's no cached manifest to verify against.")
+            await self.dialog(dialog)
+            self.set_button_state(True)
+            self.set_button_text("Play")
+            self.set_dlbox_visibility(False)
+            self.toggle_settings_state(True)
+            widget.window.close()
+            return
         except Exception:
             dialog = toga.ErrorDialog(title="Fatal Error!", message=f"Mojang has updated the game after {datetime.now().year - 2022} years!\nI haven't expected this, so the launcher doesn't support this yet.\nMake an issue on https://github.com/kenziewebm/piston-launcher!")
             await self.dialog(dialog)
             self.app.exit()
-        self.loop.call_soon_threadsafe(self.set_max_progress, (len(response.json()["files"].keys())))
-        verify_thread = threading.Thread(target=self.verify_files, args=(response,))
+        deep = widget is self.deep_verify_button
+        verify_thread = threading.Thread(target=self.verify_files, args=(game_manifest, deep))
         verify_thread.start()
         widget.window.close()
 
-    def verify_files(self, response):
-        game_manifest = response.json()["files"]
-        self.process_json_verify(game_manifest, self.settings.get("game_dir"))
+    def verify_files(self, game_manifest, deep=False):
+        report = self.launcher.verify(game_manifest, self.settings.get("game_dir"), deep)
 
         self.keep_settings_disabled = False
 
@@ -332,99 +293,74 @@ class PistonLauncher(toga.App):
         self.loop.call_soon_threadsafe(self.set_button_action, lambda button: self.launch_wrapper())
         self.loop.call_soon_threadsafe(self.set_dlbox_visibility, False)
         self.loop.call_soon_threadsafe(self.toggle_settings_state, True)
+        if report["failed"]:
+            asyncio.run_coroutine_threadsafe(self.verify_failed(report["failed"]), self.loop)
 
-    def process_json_verify(self, json_data, base_path):
-        for key, value in json_data.items():
-            if isinstance(value, dict):
-                item_type = value.get("type")
-
-                if item_type == "directory":
-                    dir_path = os.path.join(base_path, key)
-                    os.makedirs(dir_path, exist_ok=True)
-                    print(f"MKDIR {dir_path}")
-                    self.loop.call_soon_threadsafe(self.update_progress)
-
-                    self.process_json_verify(json_data=value, base_path=base_path) # yay, recursion!
-
-                elif item_type == "file":
-                    downloads = value.get("downloads", {})
-                    lzma = downloads.get("lzma")
-                    raw = downloads.get("raw")
-
-                    if os.path.exists(os.path.join(base_path, key)):
-                        verify = True
-                        download_info = raw
-                    else:
-                        verify = False
-                        download_info = lzma if lzma and self.settings["download_raw"] is False else raw
-                    
-                    if download_info:
-                        file_url = download_info.get("url")
-                        file_sha1 = download_info.get("sha1")
-                        file_path = os.path.join(base_path, key)
-
-                        if verify is True:
-                            print(f"SHA1 {file_path}", end='')
-                            if (self.verify_sha1(file_path, file_sha1)):
-                                print(" OK")
-                                self.loop.call_soon_threadsafe(self.update_progress)
-                            else:
-                                print(" BAD")
-                                self.download_file(file_url, file_path)
-                                self.loop.call_soon_threadsafe(self.update_progress)
-
-                        else:
-                            print(f"MISSING {file_path}")
-                            self.download_file(file_url, file_path)
-                            if lzma and self.settings["download_raw"] is False:
-                                print(f"LZMA {file_path} ", end='')
-                                chunk_size = self.settings.get("lzma_mem_cap")
-                                tmp_path = file_path + ".tmp"
-                                with l.open(file_path, 'rb') as cf:
-                                  with open(tmp_path, 'wb') as f:
-                                     if chunk_size == 0:
-                                         f.write(cf.read())
-                                     else:
-                                          while True:
-                                            chunk = cf.read(1024 * 1024 * chunk_size)
-                                            if not chunk:
-                                                break
-                                            f.write(chunk)
-                                os.replace(tmp_path, file_path)
-                                print("OK")
-                            self.loop.call_soon_threadsafe(self.update_progress)
+    async def verify_failed(self, failed):
+        """
+        Tell the user some files are still broken after a verify.
+        :param failed: The files that couldn't be repaired.
+        """
+        message = f"{len(failed)} files couldn't be repaired.\nVerify the game installation again to retry them."
+        await self.dialog(toga.ErrorDialog(title="Error!", message=message))
 
     def toggle_slider(self, widget):
         if self.raw_checkbox.value == True:
             self.lzma_slider.enabled = False
+            self.stream_checkbox.enabled = False
         else:
             self.lzma_slider.enabled = True
+            self.stream_checkbox.enabled = True
 
     def save_settings(self, widget):
         self.settings["game_dir"] = self.game_dir_input.value
         self.settings["lzma_mem_cap"] = int(self.lzma_slider.value)
         self.settings["download_raw"] = self.raw_checkbox.value
-        with open("settings.json", 'w') as f:
-            f.write(json.dumps(self.settings))
+        self.settings["stream_lzma"] = self.stream_checkbox.value
+        self.settings["offline"] = self.offline_checkbox.value
+        self.settings["share_files"] = self.share_checkbox.value
+        self.settings["peers"] = [url.strip() for url in self.peers_input.value.split(",") if url.strip()]
+        self.settings["download_threads"] = int(self.threads_input.value)
+        self.settings["download_limit"] = float(self.limit_input.value)
+        self.settings["object_store"] = self.store_input.value
+        self.settings["object_store_cap"] = int(self.store_cap_input.value)
+        self.launcher.session = None # rebuild the connection pool with the new size
+        launcher.save_settings(self.settings)
+        self.start_sharing()
         self.set_button_state(True)
         widget.window.close()
 
+    def start_sharing(self):
+        """
+        Start or stop serving the game files to LAN peers to match the settings.
+        """
+        if self.peer_server is not None:
+            self.peer_server.shutdown()
+            self.peer_server.server_close()
+            self.peer_server = None
+        if self.settings["share_files"] is not True or self.launcher.installed_version(self.settings["game_dir"]) is None:
+            return
+        import peer # only pulls in the HTTP server when sharing is on
+        try:
+            self.peer_server = peer.PeerServer(self.settings, self.settings["game_dir"], port=int(self.settings["peer_port"]))
+        except OSError as e:
+            print(f"PEER can't listen on port {self.settings['peer_port']} ({e})")
+            return
+        self.peer_server.serve_in_background()
+
     def startup(self):
 
         self.keep_settings_disabled = False
-        self.settings = {}
         self.game_version = None
-
-        if os.path.exists("settings.json"):
-            with open("settings.json",'r') as f:
-                self.settings = json.loads(f.read())
-
-        self.settings["game_dir"] = self.settings.get("game_dir", "dungeons")
-        self.settings["lzma_mem_cap"] = self.settings.get("lzma_mem_cap", 128)
-        self.settings["download_raw"] = self.settings.get("download_raw", False)
-        
-        with open("settings.json", 'w') as f:
-            f.write(json.dumps(self.settings))
+        self.peer_server = None
+        self.settings = launcher.load_settings()
+        if not os.path.exists("settings.json"):
+            launcher.save_settings(self.settings)
+        self.launcher = launcher.Launcher(
+            self.settings,
+            on_progress=lambda snapshot: self.loop.call_soon_threadsafe(self.show_progress, snapshot),
+        )
+        self.launcher.recover_staging(self.settings["game_dir"])
 
         self._impl.create_menus = lambda *x, **y: None # hide menubar
 
@@ -499,6 +435,20 @@ class PistonLauncher(toga.App):
 
         self.button.enabled = True
         self.set_dlbox_visibility(False)
+        self.start_sharing()
+        if self.game_version is not None:
+            self.loop.create_task(self.check_for_update())
+
+    async def check_for_update(self):
+        """
+        Check for a game update in the background once the window is up, and
+        show it next to the game version if there is one. Uses its own core
+        so it never gets in the way of an install started meanwhile.
+        """
+        checker = launcher.Launcher(self.settings)
+        update = await self.loop.run_in_executor(None, checker.check_update, self.settings["game_dir"])
+        if update is not None and self.button.text == "Play":
+            self.set_game_version(f"{self.game_version} (update available, {update['download'] // (1024 * 1024)} MB)")
 
 if __name__ == '__main__':
     app = PistonLauncher(formal_name="Piston Launcher", app_id="xyz.kenziewebm.piston-launcher")
@@ -0,0 +1,143 @@
+import os
+import marshal
+import tempfile
+
+# A compiled, flat form of the game manifest. The raw manifest is a dict of
+# path -> {"type": ..., "downloads": {"raw": {...}, "lzma": {...}}}; compiling
+# it once gives the engines a plain list of slotted records to iterate, with
+# SHA1s as bytes and the totals worked out up front.
+
+INDEX_FORMAT = 1 # bump when the layout of the cached index changes
+
+class Manifest:
+    """
+    A game manifest as fetched, plus a key identifying its contents, which
+    is what the compiled index is cached under.
+    """
+    __slots__ = ("data", "key")
+
+    def __init__(self, data, key=None):
+        self.data = data
+        self.key = key
+
+class ManifestEntry:
+    """
+    One file of the manifest.
+    """
+    __slots__ = ("path", "kind", "raw_url", "raw_sha1", "raw_size", "lzma_url", "lzma_sha1", "lzma_size", "executable")
+
+    def __init__(self, path, kind="file", raw_url=None, raw_sha1=None, raw_size=0, lzma_url=None, lzma_sha1=None, lzma_size=0, executable=False):
+        self.path = path
+        self.kind = kind
+        self.raw_url = raw_url
+        self.raw_sha1 = raw_sha1
+        self.raw_size = raw_size
+        self.lzma_url = lzma_url
+        self.lzma_sha1 = lzma_sha1
+        self.lzma_size = lzma_size
+        self.executable = executable
+
+    def download(self, download_raw=False):
+        """
+        Pick the download to use for this file.
+        :param download_raw: Prefer the uncompressed download even if there's an lzma one.
+        :return: Tuple of (url, sha1, size, compressed).
+        """
+        if self.lzma_url and download_raw is False:
+            return self.lzma_url, self.lzma_sha1, self.lzma_size, True
+        return self.raw_url, self.raw_sha1, self.raw_size, False
+
+    def as_tuple(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+class ManifestIndex:
+    """
+    Every directory and file of a manifest, flattened, with precomputed totals.
+    """
+    __slots__ = ("dirs", "files", "file_count", "raw_bytes", "lzma_bytes")
+
+    def __init__(self, dirs, files):
+        self.dirs = dirs
+        self.files = files
+        self.file_count = len(files)
+        self.raw_bytes = sum(entry.raw_size for entry in files)
+        self.lzma_bytes = sum(entry.lzma_size for entry in files)
+
+    @classmethod
+    def compile(cls, files):
+        """
+        :param files: The "files" dict of a game manifest.
+        :return: The compiled index.
+        """
+        dirs = []
+        entries = []
+        for path, value in files.items():
+            if not isinstance(value, dict):
+                continue
+            kind = value.get("type")
+            if kind == "directory":
+                dirs.append(path)
+            elif kind == "file":
+                downloads = value.get("downloads", {})
+                raw = downloads.get("raw") or {}
+                lzma = downloads.get("lzma") or {}
+                entries.append(ManifestEntry(
+                    path,
+                    kind,
+                    raw.get("url"),
+                    bytes.fromhex(raw["sha1"]) if raw.get("sha1") else None,
+                    raw.get("size", 0),
+                    lzma.get("url"),
+                    bytes.fromhex(lzma["sha1"]) if lzma.get("sha1") else None,
+                    lzma.get("size", 0),
+                    value.get("executable", False),
+                ))
+        # parents before children, so creating them in order just works
+        dirs.sort(key=lambda path: path.count("/"))
+        return cls(dirs, entries)
+
+    def download_bytes(self, download_raw=False):
+        """
+        :param download_raw: Prefer uncompressed downloads.
+        :return: How many bytes installing every file downloads.
+        """
+        return sum(entry.download(download_raw)[2] for entry in self.files)
+
+    def by_path(self):
+        """
+        :return: Dict of path -> ManifestEntry.
+        """
+        return {entry.path: entry for entry in self.files}
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load an index saved with save().
+        :return: The index, or None if it's missing, damaged or from an older launcher.
+        """
+        try:
+            with open(path, "rb") as f:
+                version, dirs, rows = marshal.loads(f.read())
+        except (OSError, ValueError, EOFError, TypeError):
+            return None
+        if version != INDEX_FORMAT:
+            return None
+        return cls(dirs, [ManifestEntry(*row) for row in rows])
+
+    def save(self, path):
+        """
+        Atomically save the index. marshal is used because it only handles
+        plain builtin types and loads much faster than JSON. The temporary
+        file gets a unique name, as two launchers may compile the same
+        manifest at once.
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(marshal.dumps((INDEX_FORMAT, self.dirs, [entry.as_tuple() for entry in self.files])))
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
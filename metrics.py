@@ -0,0 +1,192 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# Per-file phase timings for install and verify runs. Every worker thread
+# handles one file at a time, so the file being worked on is kept in a
+# thread-local and the timers below add to it without being passed around.
+
+PHASES = ["connect", "ttfb", "transfer", "hash", "decompress", "rename"]
+PHASE_BYTES = {"transfer": "downloaded", "hash": "hashed", "decompress": "decompressed"}
+
+class Metrics:
+    """
+    Collects a record per file (phase seconds, bytes, retries) and writes
+    them out with a summary of the run as JSON lines, and optionally as a
+    Prometheus textfile.
+    """
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.start_run("idle")
+
+    def start_run(self, run):
+        """
+        Forget the previous run and start collecting for a new one.
+        :param run: Name of the run, e.g. "install" or "verify".
+        """
+        with self.lock:
+            self.run = run
+            self.records = []
+            self.started = time.time()
+            self.began = time.perf_counter()
+
+    def current(self):
+        return getattr(self.local, "record", None)
+
+    @contextmanager
+    def file(self, path):
+        """
+        Collect everything done on this thread inside the block for path.
+        """
+        record = {"path": path, "retries": 0, "downloaded": 0, "hashed": 0, "decompressed": 0}
+        record.update({phase: 0.0 for phase in PHASES})
+        self.local.record = record
+        self.local.stack = []
+        began = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["total"] = time.perf_counter() - began
+            self.local.record = None
+            with self.lock:
+                self.records.append(record)
+
+    @contextmanager
+    def time(self, phase):
+        """
+        Time the block as phase of the current file. Time spent in timers
+        nested inside it is only counted for the inner phase.
+        """
+        record = self.current()
+        if record is None:
+            yield
+            return
+        stack = self.local.stack
+        stack.append(0.0)
+        began = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - began
+            nested = stack.pop()
+            record[phase] += elapsed - nested
+            if stack:
+                stack[-1] += elapsed
+
+    def add_time(self, phase, seconds):
+        """
+        Move seconds already counted by an enclosing timer over to phase,
+        e.g. the connect time measured inside a request.
+        """
+        record = self.current()
+        if record is None:
+            return
+        record[phase] += seconds
+        if self.local.stack:
+            self.local.stack[-1] += seconds
+
+    def count(self, downloaded=0, decompressed=0, hashed=0, retries=0):
+        record = self.current()
+        if record is None:
+            return
+        record["downloaded"] += downloaded
+        record["decompressed"] += decompressed
+        record["hashed"] += hashed
+        record["retries"] += retries
+
+    def summary(self):
+        """
+        :return: Dict with the run's wall time, file and retry counts, the
+                 seconds spent in each phase summed over all workers, the
+                 bytes/sec each phase managed per worker, and the slowest files.
+        """
+        with self.lock:
+            records = list(self.records)
+        phases = {}
+        for phase in PHASES:
+            seconds = sum(record[phase] for record in records)
+            phases[phase] = {"seconds": round(seconds, 4)}
+            if phase in PHASE_BYTES:
+                moved = sum(record[PHASE_BYTES[phase]] for record in records)
+                phases[phase]["bytes"] = moved
+                phases[phase]["bytes_per_second"] = round(moved / seconds) if seconds > 0 and moved else None
+        slowest = sorted(records, key=lambda record: record["total"], reverse=True)[:10]
+        return {
+            "type": "summary",
+            "run": self.run,
+            "started": self.started,
+            "wall_seconds": round(time.perf_counter() - self.began, 4),
+            "files": len(records),
+            "retries": sum(record["retries"] for record in records),
+            "phases": phases,
+            "slowest": [{"path": record["path"], "seconds": round(record["total"], 4)} for record in slowest],
+        }
+
+    def write(self, jsonl_path=None, prometheus_path=None):
+        """
+        Write out the run.
+        :param jsonl_path: File the per-file records and the summary are appended to as JSON lines.
+        :param prometheus_path: File the summary is written to in the Prometheus textfile format.
+        """
+        summary = self.summary()
+        if jsonl_path:
+            with self.lock:
+                lines = [json.dumps(dict(record, type="file", run=self.run)) for record in self.records]
+            lines.append(json.dumps(summary))
+            with open(jsonl_path, 'a') as f:
+                f.write("\n".join(lines) + "\n")
+        if prometheus_path:
+            run = summary["run"]
+            lines = [
+                "# HELP piston_run_seconds Wall time of the last run.",
+                "# TYPE piston_run_seconds gauge",
+                f'piston_run_seconds{{run="{run}"}} {summary["wall_seconds"]}',
+                "# HELP piston_run_files Files handled by the last run.",
+                "# TYPE piston_run_files gauge",
+                f'piston_run_files{{run="{run}"}} {summary["files"]}',
+                "# HELP piston_run_retries Download retries in the last run.",
+                "# TYPE piston_run_retries gauge",
+                f'piston_run_retries{{run="{run}"}} {summary["retries"]}',
+                "# HELP piston_phase_seconds Seconds spent in each per-file phase, summed over workers.",
+                "# TYPE piston_phase_seconds gauge",
+            ]
+            lines += [f'piston_phase_seconds{{run="{run}",phase="{phase}"}} {value["seconds"]}' for phase, value in summary["phases"].items()]
+            lines += [
+                "# HELP piston_phase_bytes Bytes moved by each per-file phase.",
+                "# TYPE piston_phase_bytes gauge",
+            ]
+            lines += [f'piston_phase_bytes{{run="{run}",phase="{phase}"}} {value["bytes"]}' for phase, value in summary["phases"].items() if "bytes" in value]
+            with open(prometheus_path + ".tmp", 'w') as f:
+                f.write("\n".join(lines) + "\n")
+            os.replace(prometheus_path + ".tmp", prometheus_path)
+
+def timed_pools(metrics):
+    """
+    Build urllib3 connection pool classes whose connections report how long
+    connecting (DNS, TCP and TLS) took as the "connect" phase.
+    :param metrics: The Metrics to report to.
+    :return: Dict for PoolManager.pool_classes_by_scheme.
+    """
+    from urllib3.connection import HTTPConnection, HTTPSConnection
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+    def timed(connection_class):
+        class TimedConnection(connection_class):
+            def connect(self):
+                began = time.perf_counter()
+                try:
+                    super().connect()
+                finally:
+                    metrics.add_time("connect", time.perf_counter() - began)
+        return TimedConnection
+
+    class TimedHTTPConnectionPool(HTTPConnectionPool):
+        ConnectionCls = timed(HTTPConnection)
+
+    class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+        ConnectionCls = timed(HTTPSConnection)
+
+    return {"http": TimedHTTPConnectionPool, "https": TimedHTTPSConnectionPool}
@@ -0,0 +1,133 @@
+import os
+import re
+import time
+import threading
+import http.server
+import launcher
+
+# LAN peer cache: a launcher with a verified install serves its game files
+# over plain HTTP, named by their SHA1 like the Mojang CDN does, so other
+# launchers on the network can list it in "peers" and fetch from it first.
+# Clients check every file against the manifest SHA1, peers aren't trusted.
+
+DEFAULT_PORT = 8625
+
+class PeerHandler(http.server.BaseHTTPRequestHandler):
+    """
+    GET /<sha1> returns the installed file with that SHA1, with keep-alive
+    and Range support so the client's resumable downloads work against it.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        name = self.path.strip("/")
+        path = self.server.find(name) if re.fullmatch(r"[0-9a-f]{40}", name) else None
+        if path is None:
+            self.send_error(404)
+            return
+        try:
+            file = open(path, "rb")
+        except OSError:
+            self.send_error(404)
+            return
+        with file:
+            size = os.fstat(file.fileno()).st_size
+            start = 0
+            # only the "bytes=<start>-" form resumes use; anything else gets the whole file
+            match = re.fullmatch(r"bytes=(\d+)-", self.headers.get("Range", "").strip())
+            if match and int(match.group(1)) >= size:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            if match:
+                start = int(match.group(1))
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{size - 1}/{size}")
+            else:
+                self.send_response(200)
+            self.send_header("Content-Length", str(size - start))
+            self.send_header("Content-Type", "application/octet-stream")
+            self.end_headers()
+            if size > start:
+                self.connection.sendfile(file, start, size - start)
+        print(f"PEER {self.client_address[0]} {name} OK")
+
+    def log_message(self, format, *args):
+        pass
+
+class PeerServer(http.server.ThreadingHTTPServer):
+    """
+    Serves the files of the game installed in game_dir to other launchers.
+    Only files the file-state index says were verified, and that haven't
+    changed on disk since, are handed out, plus anything in the object store.
+    """
+    daemon_threads = True
+    refresh_interval = 30 # seconds before a miss rescans the install
+
+    def __init__(self, settings, game_dir, host="", port=DEFAULT_PORT):
+        """
+        :param settings: The launcher settings.
+        :param game_dir: Directory path to the game files to share.
+        :param host: Address to listen on, all interfaces by default.
+        :param port: Port to listen on.
+        """
+        super().__init__((host, port), PeerHandler)
+        self.core = launcher.Launcher(settings)
+        self.game_dir = game_dir
+        self.lock = threading.Lock()
+        self.files = {}
+        self.refreshed = 0
+
+    def refresh(self):
+        """
+        Rebuild the SHA1 -> path map from the installed manifest.
+        """
+        files = {}
+        game_manifest = self.core.load_installed_manifest(self.game_dir)
+        self.core.load_index(self.game_dir)
+        self.core.load_store()
+        if game_manifest is not None:
+            for entry in self.core.compile_manifest(game_manifest).files:
+                if entry.raw_sha1:
+                    files[entry.raw_sha1.hex()] = (os.path.join(self.game_dir, entry.path), entry.raw_sha1)
+        self.files = files
+        self.refreshed = time.monotonic()
+        print(f"PEER sharing {len(files)} files from {self.game_dir}")
+
+    def find(self, name):
+        """
+        :param name: SHA1 of the file, in hex.
+        :return: Path to a verified copy of the file, or None if we don't have one.
+        """
+        sha1 = bytes.fromhex(name)
+        with self.lock:
+            found = self.files.get(name)
+            # an unknown SHA1 may be a new install, a known one that looks
+            # changed may have been repaired by a verify since the last scan
+            if not self.is_verified(found) and time.monotonic() - self.refreshed > self.refresh_interval:
+                self.refresh()
+                found = self.files.get(name)
+            if self.is_verified(found):
+                return found[0]
+            if self.core.store_dir is not None and os.path.exists(self.core.store_path(sha1)):
+                return self.core.store_path(sha1)
+        return None
+
+    def is_verified(self, found):
+        """
+        :param found: A (path, sha1) value of self.files, or None.
+        :return: True if the file is there and unchanged since it was last verified.
+        """
+        return found is not None and os.path.exists(found[0]) and self.core.is_unchanged(*found)
+
+    def serve_in_background(self):
+        """
+        Start serving on a daemon thread.
+        :return: The thread.
+        """
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        print(f"PEER serving {self.game_dir} on port {self.server_address[1]}")
+        return thread